@@ -0,0 +1,216 @@
+#!/usr/bin/python3
+
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from gzip import GzipFile
+from http.client import HTTPConnection
+from http.client import HTTPSConnection
+from http.client import HTTPException
+from json import loads
+from json import dumps
+from mmap import mmap
+from mmap import ACCESS_READ
+from os.path import join
+from os.path import exists
+from queue import Queue
+from queue import Empty
+from urllib.parse import quote
+from urllib.parse import urlsplit
+from urllib.error import HTTPError
+from urllib.error import URLError
+from .utils import cache_home
+from .utils import mkdir
+from .utils import atomic_file
+from .utils import advisory_lock
+from .utils import log
+from .utils import url_open_if_modified
+from .utils import LogLevel
+from .trace import span
+
+
+AUR_PACKAGES_URL = 'https://aur.archlinux.org/packages.gz'
+AUR_RPC_URL = 'https://aur.archlinux.org/rpc/?v=5&type=info'
+AUR_RPC_MAX_URL_LENGTH = 4000
+AUR_RPC_CONNECTIONS = 4
+
+
+class SortedNameIndex:
+    """ Read-only set of names, backed by a memory-mapped file with one name per line in sorted order. """
+
+    def __init__(self, path):
+        """ :param path: Path to the index file. """
+        self.path = path
+        with open(path, mode='rb') as file:
+            try:
+                self.mapped = mmap(file.fileno(), 0, access=ACCESS_READ)
+            except ValueError:
+                # Cannot map an empty file.
+                self.mapped = b''
+
+    def __contains__(self, name):
+        """ Binary search over lines.
+        :param name: The name to look up. CASE SENSITIVE.
+        :return: True if and only if the name is in this index.
+        """
+        target = name.encode()
+        mapped = self.mapped
+        low = 0
+        high = len(mapped)
+        while low < high:
+            middle = (low + high) // 2
+            start = mapped.rfind(b'\n', 0, middle) + 1
+            end = mapped.find(b'\n', start)
+            if end < 0:
+                end = len(mapped)
+            line = mapped[start:end]
+            if line == target:
+                return True
+            elif line < target:
+                low = end + 1
+            else:
+                high = start
+        return False
+
+    @staticmethod
+    def write(path, names):
+        """ Atomically writes an index file.
+        :param path: Path to the index file.
+        :param names: Iterable of names.
+        """
+        with atomic_file(path, mode='wb') as file:
+            for name in sorted(set(names)):
+                file.write(name.encode() + b'\n')
+
+
+def aur_package_names():
+    """ Obtains the names of all AUR packages, using the on-disk index refreshed with a conditional request.
+    The index is shared among repositories, so it is refreshed by one run at a time.
+    :return: SortedNameIndex of the names of AUR packages.
+    """
+    directory = mkdir(join(cache_home, 'aur'))
+    index_path = join(directory, 'packages')
+    validator_path = join(directory, 'packages.json')
+    with open(join(directory, '.lock'), mode='a') as lock:
+        with advisory_lock(lock):
+            validator = dict()
+            if exists(index_path) and exists(validator_path):
+                with open(validator_path) as file:
+                    validator = loads(file.read())
+            try:
+                with url_open_if_modified(AUR_PACKAGES_URL, validator) as (response, validator):
+                    if response is None:
+                        log(LogLevel.fine, 'Not modified: {}', AUR_PACKAGES_URL)
+                    else:
+                        with GzipFile(fileobj=response) as lines:
+                            SortedNameIndex.write(index_path, [name for name in
+                                                               (line.decode().strip() for line in lines)
+                                                               if len(name) > 0 and name[0] != '#'])
+                        with atomic_file(validator_path) as file:
+                            file.write(dumps(validator))
+            except URLError as e:
+                if not exists(index_path):
+                    raise e
+                log(LogLevel.warn, 'Using cached list of AUR packages: {}', e.reason)
+    return SortedNameIndex(index_path)
+
+
+class ConnectionPool:
+    """ A small pool of keep-alive HTTP(S) connections to a single host. """
+
+    def __init__(self, url):
+        """ :param url: Any URL on the host. Only the scheme and the network location are used. """
+        split_url = urlsplit(url)
+        self.scheme = split_url.scheme
+        self.netloc = split_url.netloc
+        self.idle = Queue()
+
+    def new_connection(self):
+        """ :return: A new connection to the host. """
+        if self.scheme == 'https':
+            return HTTPSConnection(self.netloc)
+        return HTTPConnection(self.netloc)
+
+    def get(self, path):
+        """ Fetches a resource, reusing an idle connection if any.
+        :param path: The path (with query) of the resource.
+        :return: Fetched response.
+        """
+        url = '{}://{}{}'.format(self.scheme, self.netloc, path)
+        log(LogLevel.fine, url)
+        try:
+            connection = self.idle.get_nowait()
+        except Empty:
+            connection = self.new_connection()
+        for retrial in range(2):
+            try:
+                with span('get', category='url', url=url):
+                    connection.request('GET', path)
+                    response = connection.getresponse()
+                    body = response.read()
+            except (HTTPException, ConnectionError):
+                # The server may have closed the idle connection. Retry once with a fresh one.
+                connection.close()
+                if retrial > 0:
+                    raise
+                connection = self.new_connection()
+                continue
+            if response.status != 200:
+                connection.close()
+                raise HTTPError(url, response.status, response.reason, response.headers, None)
+            self.idle.put(connection)
+            return body
+
+
+@lru_cache(maxsize=None)
+def connection_pool(url):
+    """ :param url: Any URL on the host.
+    :return: The shared ConnectionPool for the host.
+    """
+    return ConnectionPool(url)
+
+
+def chunk_rpc_paths(path, pkgnames, max_url_length):
+    """ Splits an RPC info query into queries of bounded length.
+    :param path: The path (with query) of the RPC endpoint, without arguments.
+    :param pkgnames: The names of the packages to query.
+    :param max_url_length: The maximum length of each path.
+    :return: List of paths with arguments.
+    """
+    paths = list()
+    arguments = list()
+    length = len(path)
+    for pkgname in pkgnames:
+        argument = '&arg[]=' + quote(pkgname, safe='')
+        if len(arguments) > 0 and length + len(argument) > max_url_length:
+            paths.append(path + ''.join(arguments))
+            arguments = list()
+            length = len(path)
+        arguments.append(argument)
+        length += len(argument)
+    if len(arguments) > 0:
+        paths.append(path + ''.join(arguments))
+    return paths
+
+
+def aur_rpc_info(pkgnames, rpc_url=AUR_RPC_URL, max_url_length=AUR_RPC_MAX_URL_LENGTH,
+                 connections=AUR_RPC_CONNECTIONS):
+    """ Queries AUR RPC for package information, with length-bounded queries sent concurrently.
+    :param pkgnames: The names of the packages to query.
+    :param rpc_url: URL of the RPC info endpoint.
+    :param max_url_length: The maximum length of the path of each query.
+    :param connections: The maximum number of concurrent connections.
+    :return: List of the results, in the order of pkgnames.
+    """
+    split_url = urlsplit(rpc_url)
+    path = '{}?{}'.format(split_url.path, split_url.query)
+    paths = chunk_rpc_paths(path, pkgnames, max_url_length)
+    if len(paths) == 0:
+        return list()
+    pool = connection_pool(rpc_url)
+    if len(paths) == 1:
+        bodies = [pool.get(paths[0])]
+    else:
+        with ThreadPoolExecutor(max_workers=min(connections, len(paths))) as executor:
+            bodies = list(executor.map(pool.get, paths))
+    name_to_result = {result['Name']: result for body in bodies for result in loads(body.decode())['results']}
+    return [name_to_result[pkgname] for pkgname in pkgnames if pkgname in name_to_result]
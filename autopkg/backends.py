@@ -1,15 +1,16 @@
 #!/usr/bin/python3
 
-from gzip import decompress
+from concurrent.futures import ThreadPoolExecutor
 from json import loads
 from os.path import join
+from os.path import exists
 from os.path import split
 from os.path import basename
 from urllib.error import HTTPError
 from contextlib import AbstractContextManager
 from contextlib import contextmanager
 from .utils import run
-from .utils import url_read
+from .utils import url_open_if_modified
 from .utils import config
 from .utils import workspace
 from .utils import log
@@ -17,11 +18,22 @@ from .utils import LogLevel
 from .utils import dedup
 from .package import PackageInfo
 from .package import Version
+from .aur import aur_package_names
+from .aur import aur_rpc_info
+from .metadata import metadata_cache
+from .mirror import git_mirror
+from .mirror import aur_mirror
+from .mirror import mirror_commit
+from .mirror import mirror_checkout
+from .mirror import remote_refs
+from .mirror import remote_commit
 
 
 class SourceReference:
     """ Reference to specific package source from specific backend. """
 
+    __slots__ = ('backend', 'source')
+
     def __init__(self, backend, source):
         """
         :param backend: The backend.
@@ -46,6 +58,9 @@ class SourceReference:
 
 
 class AbstractBuildable:
+    # The name of the backend, which is also the name of its metadata cache.
+    backend_name = None
+
     def __init__(self, package_info, source_reference):
         self.package_info = package_info
         self.source_reference = source_reference
@@ -59,6 +74,14 @@ class AbstractBuildable:
     def write_pkgbuild_to(self, path):
         raise Exception('Not implemented.')
 
+    def to_json(self):
+        raise Exception('Not implemented.')
+
+    @property
+    def metadata_key(self):
+        """ :return: The key of the source of this Buildable in the metadata cache of the backend. """
+        raise Exception('Not implemented.')
+
     @property
     def chroot_required(self):
         """ :return: True. """
@@ -66,6 +89,8 @@ class AbstractBuildable:
 
 
 class AURBuildable(AbstractBuildable):
+    backend_name = 'aur'
+
     def __init__(self, package_info):
         super().__init__(package_info, SourceReference('aur', package_info.pkgbase))
 
@@ -73,10 +98,18 @@ class AURBuildable(AbstractBuildable):
         """ :param path: Path to workspace.
         :return: Path to the leaf directory where PKGBUILD resides.
         """
-        giturl = 'https://aur.archlinux.org/{}.git'.format(self.package_info.pkgbase)
-        run(['git', 'clone', '--depth', '1', giturl, path], capture=False)
+        mirror_checkout(aur_mirror(self.package_info.pkgbase), 'master', path, shared=False)
         return path
 
+    def to_json(self):
+        """ :return: JSON representation of this AURBuildable. """
+        return {'backend': self.backend_name, 'package_info': self.package_info.to_json()}
+
+    @property
+    def metadata_key(self):
+        """ :return: The name of the package. """
+        return self.package_info.pkgname
+
     @property
     def chroot_required(self):
         """ :return: True. """
@@ -94,27 +127,37 @@ def aur_backend(pkgnames):
     """ :param pkgnames: The names of the packages to lookup.
     :return: List of related AURBuildables.
     """
-    try:
-        aur_backend.aur_packages
-    except AttributeError:
-        fetched = url_read('https://aur.archlinux.org/packages.gz')
-        aur_backend.aur_packages = [name for name in decompress(fetched).decode().splitlines()
-                                    if len(name) > 0 and name[0] != '#']
-    buildables = list()
-    query_targets = ['&arg[]=' + pkgname for pkgname in pkgnames if pkgname in aur_backend.aur_packages]
-    if len(query_targets) > 0:
-        json = loads(url_read('https://aur.archlinux.org/rpc/?v=5&type=info' + ''.join(query_targets)).decode())
-        for result in json['results']:
-            buildable = AURBuildable(PackageInfo(result['Name'], result['Version'], pkgbase=result['PackageBase'],
+    metadata = metadata_cache('aur')
+    pkgname_to_package_info = dict()
+    stale_pkgnames = list()
+    for pkgname in pkgnames:
+        cached = metadata.lookup(pkgname)
+        if cached is not None:
+            pkgname_to_package_info[pkgname] = PackageInfo.from_json(cached)
+        else:
+            stale_pkgnames.append(pkgname)
+    if len(stale_pkgnames) > 0:
+        try:
+            aur_backend.aur_packages
+        except AttributeError:
+            aur_backend.aur_packages = aur_package_names()
+        for result in aur_rpc_info([pkgname for pkgname in stale_pkgnames if pkgname in aur_backend.aur_packages]):
+            cached = metadata.validate(result['Name'], result['LastModified'])
+            if cached is None:
+                cached = PackageInfo(result['Name'], result['Version'], pkgbase=result['PackageBase'],
                                      depends=extract_package_names(result.get('Depends', list())),
                                      makedepends=extract_package_names(result.get('MakeDepends', list())),
-                                     checkdepends=extract_package_names(result.get('CheckDepends', list()))))
-            buildables.append(buildable)
-    return buildables
+                                     checkdepends=extract_package_names(result.get('CheckDepends', list()))).to_json()
+            metadata.put(result['Name'], result['LastModified'], cached)
+            pkgname_to_package_info[result['Name']] = PackageInfo.from_json(cached)
+        metadata.save()
+    return [AURBuildable(pkgname_to_package_info[pkgname]) for pkgname in pkgnames
+            if pkgname in pkgname_to_package_info]
 
 
 GSHELLEXT_PKGREL = '-1'
 GSHELLEXT_PREFIX = 'gnome-shell-extension-'
+GSHELLEXT_WORKERS = 8
 GSHELLEXT_PKGBUILD_FORMAT = """
 pkgname='{}'
 pkgver={}
@@ -142,6 +185,8 @@ package() {{
 
 
 class GShellExtBuildable(AbstractBuildable):
+    backend_name = 'gshellext'
+
     def __init__(self, package_info, uuid, version, version_tag, description, link):
         super().__init__(package_info, SourceReference('gshellext', uuid))
         self.uuid = uuid
@@ -161,6 +206,17 @@ class GShellExtBuildable(AbstractBuildable):
             f.write(pkgbuild)
         return path
 
+    def to_json(self):
+        """ :return: JSON representation of this GShellExtBuildable. """
+        return {'backend': self.backend_name, 'package_info': self.package_info.to_json(), 'uuid': self.uuid,
+                'version': self.version, 'version_tag': self.version_tag, 'description': self.description,
+                'link': self.link}
+
+    @property
+    def metadata_key(self):
+        """ :return: The UUID of the extension. """
+        return self.uuid
+
     @property
     def chroot_required(self):
         """ :return: False. """
@@ -169,36 +225,96 @@ class GShellExtBuildable(AbstractBuildable):
 
 def gshellext_backend(pkgnames):
     """ :param pkgnames: The names of the packages to lookup.
-    :return: List of related AURBuildables.
+    :return: List of related GShellExtBuildables.
     """
+    uuids = [pkgname[len(GSHELLEXT_PREFIX):] for pkgname in pkgnames if pkgname.startswith(GSHELLEXT_PREFIX)]
+    if len(uuids) == 0:
+        return list()
+    metadata = metadata_cache('gshellext')
+    uuid_to_entry = dict()
+    stale_uuids = list()
+    for uuid in uuids:
+        cached = metadata.lookup(uuid)
+        if cached is not None:
+            uuid_to_entry[uuid] = cached
+        else:
+            stale_uuids.append(uuid)
+    if len(stale_uuids) > 0:
+        for uuid, entry in zip(stale_uuids, gshellext_lookups(stale_uuids, metadata)):
+            if entry is None:
+                continue
+            # The conditional request has already revalidated the cached entry, so only count the result.
+            metadata.record(metadata.token(uuid) == entry['version_tag'])
+            metadata.put(uuid, entry['version_tag'], entry)
+            uuid_to_entry[uuid] = entry
+        metadata.save()
     buildables = list()
-    for pkgname in pkgnames:
-        if not pkgname.startswith(GSHELLEXT_PREFIX):
+    for uuid in uuids:
+        if uuid not in uuid_to_entry:
             continue
-        uuid = pkgname[len(GSHELLEXT_PREFIX):]
-        try:
-            json = loads(url_read('https://extensions.gnome.org/extension-info/?uuid={}', uuid).decode())
-        except HTTPError:
-            continue
-        recent_version_pair = max(json['shell_version_map'].values(), key=lambda pair: pair['version'])
-        recent_version = recent_version_pair['version']
-        recent_version_tag = recent_version_pair['pk']
-        escaped_description = json['description'].replace('\'', '\'\"\'\"\'')
-        package_info = PackageInfo(GSHELLEXT_PREFIX + uuid.lower(), str(recent_version) + GSHELLEXT_PKGREL)
-        buildable = GShellExtBuildable(package_info, uuid, recent_version, recent_version_tag, escaped_description,
-                                       json['link'])
+        entry = uuid_to_entry[uuid]
+        escaped_description = entry['description'].replace('\'', '\'\"\'\"\'')
+        package_info = PackageInfo(GSHELLEXT_PREFIX + uuid.lower(), str(entry['version']) + GSHELLEXT_PKGREL)
+        buildable = GShellExtBuildable(package_info, uuid, entry['version'], entry['version_tag'],
+                                       escaped_description, entry['link'])
         buildables.append(buildable)
     return buildables
 
 
+def gshellext_lookups(uuids, metadata):
+    """ Looks up extensions concurrently, revalidating their cached entries.
+    :param uuids: The UUIDs of the extensions.
+    :param metadata: The MetadataCache of the backend.
+    :return: List of the up-to-date entries, in the order of uuids. None for extensions not found.
+    """
+    if len(uuids) == 0:
+        return list()
+    with ThreadPoolExecutor(max_workers=min(GSHELLEXT_WORKERS, len(uuids))) as executor:
+        return list(executor.map(lambda uuid: gshellext_lookup(uuid, metadata.cached(uuid)), uuids))
+
+
+def gshellext_lookup(uuid, entry):
+    """ Looks up an extension, revalidating the cached entry if any.
+    :param uuid: The UUID of the extension.
+    :param entry: The cached entry for the extension. None if not cached.
+    :return: The up-to-date entry for the extension. None if not found.
+    """
+    url = 'https://extensions.gnome.org/extension-info/?uuid={}'.format(uuid)
+    try:
+        with url_open_if_modified(url, entry['validator'] if entry else dict()) as (response, validator):
+            if response is None:
+                return entry
+            json = loads(response.read().decode())
+    except HTTPError:
+        return None
+    recent_version_pair = max(json['shell_version_map'].values(), key=lambda pair: pair['version'])
+    return {'validator': validator,
+            'version': recent_version_pair['version'],
+            'version_tag': recent_version_pair['pk'],
+            'description': json['description'],
+            'link': json['link']}
+
+
 @contextmanager
-def config_git_backend():
-    with config('git') as config_data:
+def config_git_backend(shared=False):
+    with config('git', shared=shared) as config_data:
         if config_data.json is None:
             config_data.json = []
         yield config_data
 
 
+def git_sources():
+    """ :return: The configured git sources, read once per run so that planning and the plan snapshot see the same
+    sources even if the configuration changes meanwhile.
+    """
+    try:
+        return git_sources.sources
+    except AttributeError:
+        with config_git_backend(shared=True) as config_data:
+            git_sources.sources = config_data.json
+        return git_sources.sources
+
+
 def git_backend(pkgnames):
     try:
         git_backend.pkgname_to_buildable
@@ -209,42 +325,96 @@ def git_backend(pkgnames):
 
 
 def do_git():
-    with config_git_backend() as config_data:
-        with Workspaces() as wss:
-            repo_url_to_workspace = dict()
-            pkgname_to_buildable = dict()
-            for source in config_data.json:
-                repo_url = source['repository']
-                repo_path = source['path']
-                branch = source['branch']
-                if repo_url not in repo_url_to_workspace:
-                    ws = wss.new_workspace()
-                    run(['git', 'clone', repo_url, ws], capture=False)
-                    repo_url_to_workspace[repo_url] = ws
-                ws = repo_url_to_workspace[repo_url]
-                path = join(ws, repo_path)
-                run(['git', 'checkout', branch], cwd=ws, quiet=True)
-                version = Version.from_components(value_from_pkgbuild(path, 'pkgver'),
-                                                  value_from_pkgbuild(path, 'pkgrel'),
-                                                  epoch=value_from_pkgbuild(path, 'epoch'))
-                pkgnames = array_from_pkgbuild(path, 'pkgname')
-                pkgbase = value_from_pkgbuild(path, 'pkgbase')
-                depends = extract_package_names(array_from_pkgbuild(path, 'depends'))
-                makedepends=extract_package_names(array_from_pkgbuild(path, 'makedepends'))
-                checkdepends=extract_package_names(array_from_pkgbuild(path, 'checkdepends'))
-                for pkgname in pkgnames:
-                    source_reference = GitSourceReference(repo_url, repo_path, branch)
-                    package_info = PackageInfo(pkgname, version, pkgbase=pkgbase, depends=depends,
-                                               makedepends=makedepends, checkdepends=checkdepends)
-                    buildable = GitBuildable(package_info, source_reference, repo_url, repo_path, branch)
-                    if pkgname in pkgname_to_buildable:
-                        log(LogLevel.warn, 'Multiple git sources for pkgname {}', pkgname)
-                    else:
-                        pkgname_to_buildable[pkgname] = buildable
+    metadata = metadata_cache('git')
+    sources = [(source['repository'], source['path'], source['branch']) for source in git_sources()]
+    key_to_fields = dict()
+    stale_sources = list()
+    for source in sources:
+        fields = metadata.lookup(' '.join(source))
+        if fields is None:
+            stale_sources.append(source)
+        else:
+            key_to_fields[' '.join(source)] = fields
+    # Learn the current heads with one cheap pass, so that unchanged sources need neither fetch nor checkout.
+    commits = git_commits([(repo_url, branch) for repo_url, repo_path, branch in stale_sources])
+    with Workspaces() as wss:
+        commit_to_workspace = dict()
+        for (repo_url, repo_path, branch), commit in zip(stale_sources, commits):
+            key = ' '.join([repo_url, repo_path, branch])
+            fields = metadata.validate(key, commit)
+            if fields is None:
+                if commit not in commit_to_workspace:
+                    commit_to_workspace[commit] = mirror_checkout(git_mirror(repo_url), commit,
+                                                                  wss.new_workspace())
+                fields = fields_from_pkgbuild(join(commit_to_workspace[commit], repo_path))
+            metadata.put(key, commit, fields)
+            key_to_fields[key] = fields
+    pkgname_to_buildable = dict()
+    for repo_url, repo_path, branch in sources:
+        fields = key_to_fields[' '.join([repo_url, repo_path, branch])]
+        version = Version(fields['version'])
+        for pkgname in fields['pkgnames']:
+            source_reference = GitSourceReference(repo_url, repo_path, branch)
+            package_info = PackageInfo(pkgname, version, pkgbase=fields['pkgbase'], depends=fields['depends'],
+                                       makedepends=fields['makedepends'], checkdepends=fields['checkdepends'])
+            buildable = GitBuildable(package_info, source_reference, repo_url, repo_path, branch)
+            if pkgname in pkgname_to_buildable:
+                log(LogLevel.warn, 'Multiple git sources for pkgname {}', pkgname)
+            else:
+                pkgname_to_buildable[pkgname] = buildable
+    metadata.save()
     return pkgname_to_buildable
 
 
+def git_commits(revisions):
+    """ Resolves revisions of git repositories with one 'git ls-remote' for each repository.
+    :param revisions: List of pairs of the URL of a repository and a branch, a tag or a commit.
+    :return: List of the commit ids, in the order of revisions.
+    """
+    repo_url_to_refs = remote_refs(dedup([repo_url for repo_url, revision in revisions]))
+    commits = list()
+    for repo_url, revision in revisions:
+        commit = remote_commit(repo_url_to_refs[repo_url], revision)
+        if commit is None:
+            # Not an advertised ref (e.g. a commit id). Resolve it using the mirror.
+            commit = mirror_commit(git_mirror(repo_url), revision)
+        commits.append(commit)
+    return commits
+
+
+PKGBUILD_FIELDS = ['pkgname', 'pkgbase', 'pkgver', 'pkgrel', 'epoch', 'depends', 'makedepends', 'checkdepends',
+                   'provides']
+
+
+def fields_from_pkgbuild(path):
+    """ :param path: Path to the directory where PKGBUILD resides.
+    :return: Dictionary of the metadata of the PKGBUILD, read from .SRCINFO if present.
+    """
+    if exists(join(path, '.SRCINFO')):
+        values = values_from_srcinfo(path)
+    else:
+        values = values_from_pkgbuild(path, PKGBUILD_FIELDS)
+    version = Version.from_components(first_value(values['pkgver']), first_value(values['pkgrel']),
+                                      epoch=first_value(values['epoch']))
+    return {'pkgnames': values['pkgname'],
+            'pkgbase': first_value(values['pkgbase']),
+            'version': str(version),
+            'depends': extract_package_names(values['depends']),
+            'makedepends': extract_package_names(values['makedepends']),
+            'checkdepends': extract_package_names(values['checkdepends']),
+            'provides': extract_package_names(values['provides'])}
+
+
+def first_value(values):
+    """ :param values: List of values of a variable.
+    :return: The first value. None if the variable is unset or empty.
+    """
+    return values[0] if len(values) > 0 and len(values[0]) > 0 else None
+
+
 class GitBuildable(AbstractBuildable):
+    backend_name = 'git'
+
     def __init__(self, package_info, source_reference, repo_url, path, branch):
         super().__init__(package_info, source_reference)
         self.repo_url = repo_url
@@ -255,9 +425,19 @@ class GitBuildable(AbstractBuildable):
         """ :param path: Path to workspace.
         :return: Path to the leaf directory where PKGBUILD resides.
         """
-        run(['git', 'clone', '--depth', '1', '--branch', self.branch, self.repo_url, path], capture=False)
+        mirror_checkout(git_mirror(self.repo_url), self.branch, path)
         return join(path, self.path)
 
+    def to_json(self):
+        """ :return: JSON representation of this GitBuildable. """
+        return {'backend': self.backend_name, 'package_info': self.package_info.to_json(),
+                'repo_url': self.repo_url, 'path': self.path, 'branch': self.branch}
+
+    @property
+    def metadata_key(self):
+        """ :return: The repository, the path and the branch of the source. """
+        return ' '.join([self.repo_url, self.path, self.branch])
+
     @property
     def chroot_required(self):
         """ :return: True. """
@@ -288,18 +468,101 @@ class GitSourceReference:
         return self.repo_url == other.repo_url and self.path == other.path and self.branch == other.branch
 
 
-def value_from_pkgbuild(cwd, name):
-    stdout = run(['bash', '-c', 'set +u && . PKGBUILD && echo "${}"'.format(name)], cwd=cwd, quiet=True).strip()
-    if len(stdout):
-        return stdout
-    else:
-        return None
+def values_from_pkgbuild(cwd, names):
+    """ Sources PKGBUILD once and reads the variables.
+    :param cwd: Path to the directory where PKGBUILD resides.
+    :param names: The names of the variables.
+    :return: Dictionary from the name of each variable to the list of its values.
+    """
+    # For each variable, print the number of values followed by the values, separated by NUL. Whatever PKGBUILD
+    # itself prints while being sourced is discarded so that it cannot be mistaken for the values.
+    arguments = ''.join(' "${{#{0}[@]}}" "${{{0}[@]}}"'.format(name) for name in names)
+    script = 'set +u && . ./PKGBUILD >/dev/null && printf "%s\\0"' + arguments
+    stdout = run(['bash', '-c', script], cwd=cwd, quiet=True)
+    tokens = stdout.split('\0')
+    values = dict()
+    index = 0
+    for name in names:
+        count = int(tokens[index])
+        values[name] = [value for value in tokens[index + 1:index + 1 + count] if len(value)]
+        index += 1 + count
+    return values
+
+
+def values_from_srcinfo(cwd):
+    """ Reads the variables from .SRCINFO without invoking bash.
+    Only the pkgbase section is taken into account, except for the names of the packages.
+    :param cwd: Path to the directory where .SRCINFO resides.
+    :return: Dictionary from the name of each variable in PKGBUILD_FIELDS to the list of its values.
+    """
+    values = {name: list() for name in PKGBUILD_FIELDS}
+    in_pkgbase_section = True
+    with open(join(cwd, '.SRCINFO')) as file:
+        for line in file:
+            line = line.strip()
+            if len(line) == 0 or line.startswith('#'):
+                continue
+            key, _, value = line.partition('=')
+            key = key.strip()
+            value = value.strip()
+            if key == 'pkgname':
+                in_pkgbase_section = False
+                values['pkgname'].append(value)
+            elif in_pkgbase_section and key in values and len(value) > 0:
+                values[key].append(value)
+    return values
+
+
+def buildable_from_json(json):
+    """ :param json: JSON representation from the to_json of a Buildable.
+    :return: The Buildable.
+    """
+    package_info = PackageInfo.from_json(json['package_info'])
+    if json['backend'] == AURBuildable.backend_name:
+        return AURBuildable(package_info)
+    elif json['backend'] == GShellExtBuildable.backend_name:
+        return GShellExtBuildable(package_info, json['uuid'], json['version'], json['version_tag'],
+                                  json['description'], json['link'])
+    elif json['backend'] == GitBuildable.backend_name:
+        return GitBuildable(package_info, GitSourceReference(json['repo_url'], json['path'], json['branch']),
+                            json['repo_url'], json['path'], json['branch'])
+    raise Exception('Unknown backend: {}'.format(json['backend']))
+
+
+def recorded_token(buildable):
+    """ :param buildable: The Buildable from a backend.
+    :return: The freshness token of the source that the Buildable has been obtained from. None if unknown.
+    """
+    return metadata_cache(buildable.backend_name).token(buildable.metadata_key)
 
 
-def array_from_pkgbuild(cwd, name):
-    stdout = run(['bash', '-c', 'set +u && . PKGBUILD && printf "%s\\n" "${{{}[@]}}"'.format(name)],
-                 cwd=cwd, quiet=True)
-    return [value for value in stdout.splitlines() if len(value)]
+def current_tokens(buildables):
+    """ Checks the sources of Buildables for changes, with one batch of cheap queries for each backend. Tokens cached
+    within AUTOPKG_CACHE_TTL are trusted without checking upstream, as the backends do.
+    :param buildables: List of Buildables from the backends.
+    :return: List of the current freshness tokens of the sources, in the order of buildables. None for gone sources.
+    """
+    key_to_token = dict()
+    name_to_stale_buildables = {AURBuildable.backend_name: list(), GShellExtBuildable.backend_name: list(),
+                                GitBuildable.backend_name: list()}
+    for buildable in buildables:
+        metadata = metadata_cache(buildable.backend_name)
+        if metadata.lookup(buildable.metadata_key) is not None:
+            key_to_token[buildable.backend_name, buildable.metadata_key] = metadata.token(buildable.metadata_key)
+        else:
+            name_to_stale_buildables[buildable.backend_name].append(buildable)
+    stale_pkgnames = dedup([buildable.metadata_key for buildable in name_to_stale_buildables['aur']])
+    for result in aur_rpc_info(stale_pkgnames):
+        key_to_token['aur', result['Name']] = result['LastModified']
+    stale_uuids = dedup([buildable.metadata_key for buildable in name_to_stale_buildables['gshellext']])
+    for uuid, entry in zip(stale_uuids, gshellext_lookups(stale_uuids, metadata_cache('gshellext'))):
+        if entry is not None:
+            key_to_token['gshellext', uuid] = entry['version_tag']
+    stale_git_buildables = name_to_stale_buildables['git']
+    commits = git_commits([(buildable.repo_url, buildable.branch) for buildable in stale_git_buildables])
+    for buildable, commit in zip(stale_git_buildables, commits):
+        key_to_token['git', buildable.metadata_key] = commit
+    return [key_to_token.get((buildable.backend_name, buildable.metadata_key)) for buildable in buildables]
 
 
 class Workspaces(AbstractContextManager):
@@ -0,0 +1,116 @@
+#!/usr/bin/python3
+
+from hashlib import sha256
+from os import link
+from os import listdir
+from os import readlink
+from os import rename
+from os import utime
+from os import walk
+from os.path import basename
+from os.path import exists
+from os.path import getmtime
+from os.path import getsize
+from os.path import islink
+from os.path import join
+from os.path import relpath
+from .utils import run
+from .utils import mkdir
+from .utils import advisory_lock
+from .utils import cache_home
+from .utils import build_cache_capacity
+
+
+build_cache_home = join(cache_home, 'build')
+
+
+def build_cache_key(pkgbuild_dir, requisite_hashes, chroot):
+    """ :param pkgbuild_dir: The path to the directory where PKGBUILD resides, before building.
+    :param requisite_hashes: List of pairs of the name and the SHA-256 of each requisite package.
+    :param chroot: Whether to build in chroot environment or not.
+    :return: Key of the build, which is the hash of everything the build depends on.
+    """
+    key = sha256()
+    key.update(b'chroot\0' if chroot else b'host\0')
+    for root, directories, file_names in walk(pkgbuild_dir):
+        directories[:] = sorted(directory for directory in directories if directory != '.git')
+        for file_name in sorted(file_names):
+            path = join(root, file_name)
+            key.update(relpath(path, pkgbuild_dir).encode() + b'\0')
+            if islink(path):
+                key.update(b'link\0' + readlink(path).encode() + b'\0')
+                continue
+            with open(path, mode='rb') as file:
+                for block in iter(lambda: file.read(1 << 20), b''):
+                    key.update(block)
+            key.update(b'\0')
+    for pkgname, package_hash in sorted(requisite_hashes):
+        key.update('requisite\0{}\0{}\0'.format(pkgname, package_hash).encode())
+    return key.hexdigest()
+
+
+def restore_build(key, directory):
+    """ Places the package files of a cached build.
+    :param key: Key of the build.
+    :param directory: The directory to place the package files in.
+    :return: Whether the build has been cached or not.
+    """
+    if build_cache_capacity <= 0:
+        return False
+    path = join(mkdir(build_cache_home), key)
+    with open(join(build_cache_home, '.lock'), mode='a') as file:
+        with advisory_lock(file):
+            if not exists(path):
+                return False
+            for file_name in listdir(path):
+                link_or_copy(join(path, file_name), join(directory, file_name))
+            utime(path)
+    return True
+
+
+def store_build(key, package_file_paths):
+    """ Caches the package files of a build. The least recently used builds are evicted to keep the cache within
+    AUTOPKG_BUILD_CACHE_SIZE.
+    :param key: Key of the build.
+    :param package_file_paths: The paths to the package files.
+    """
+    if build_cache_capacity <= 0:
+        return
+    path = join(mkdir(build_cache_home), key)
+    with open(join(build_cache_home, '.lock'), mode='a') as file:
+        with advisory_lock(file):
+            if exists(path):
+                return
+            # Fill aside so that an interrupted copy does not leave an incomplete build behind.
+            temporary_path = path + '.tmp'
+            run(['rm', '-rf', temporary_path], quiet=True)
+            mkdir(temporary_path)
+            for package_file_path in package_file_paths:
+                link_or_copy(package_file_path, join(temporary_path, basename(package_file_path)))
+            rename(temporary_path, path)
+            evict_builds(build_cache_capacity)
+
+
+def evict_builds(capacity):
+    """ Removes the least recently used builds.
+    :param capacity: The total size of builds to keep, in bytes.
+    """
+    paths = [join(build_cache_home, name) for name in listdir(build_cache_home)
+             if not name.startswith('.') and not name.endswith('.tmp')]
+    paths.sort(key=getmtime, reverse=True)
+    total_size = 0
+    for path in paths:
+        total_size += sum(getsize(join(path, file_name)) for file_name in listdir(path))
+        if total_size > capacity:
+            run(['rm', '-rf', path], quiet=True)
+
+
+def link_or_copy(source, destination):
+    """ Hard-links a file, or copies it (with a reflink if possible) across file systems.
+    :param source: The path to the file.
+    :param destination: The path to the link or the copy.
+    """
+    try:
+        link(source, destination)
+    except OSError:
+        run(['cp', '--reflink=auto', source, destination], quiet=True)
@@ -1,40 +1,104 @@
 #!/usr/bin/python3
 
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
+from concurrent.futures import FIRST_COMPLETED
 from contextlib import contextmanager
+from os import listdir
 from os.path import join
 from os.path import isdir
+from os.path import exists
+from os.path import getmtime
+from pathlib import Path
+from queue import Queue
 from subprocess import CalledProcessError
+from threading import Lock
+from time import time
 from .utils import workspace
 from .utils import run
 from .utils import mkdir
+from .utils import advisory_lock
+from .utils import chroot_home
+from .utils import chroot_refresh_interval
 from .utils import num_retrials
+from .utils import num_jobs
 from .utils import log
 from .utils import LogLevel
 from .repository import Repository
 from .package import pick_package_file
+from .package import package_files
+from .trace import span
+from .buildcache import build_cache_key
+from .buildcache import restore_build
+from .buildcache import store_build
 
 
 @contextmanager
 def arch_root():
-    """ :return: Context manager for an Arch chroot. """
+    """ :return: Context manager for an Arch chroot, copied from the persistent template. """
     with workspace() as path:
         chroot_root = join(path, 'root')
-        chroot_working = join(path, 'working')
-        run(['mkarchroot', chroot_root, 'base-devel'], capture=False)
-        run(['tee', '-a', chroot_root + '/etc/pacman.conf'], sudo=True,
-            stdin='\n[autopkg]\nSigLevel = Never\nServer = file:///repo\n')
+        with span('chroot setup'):
+            with open(join(mkdir(chroot_home), 'template.lock'), mode='a') as file:
+                # Exclusive only while the template is created or upgraded, so that runs for other repositories can
+                # copy it at the same time. Creating or upgrading it may legitimately take longer than
+                # AUTOPKG_LOCK_TIMEOUT, so the lock is waited for without limit.
+                description = 'the template chroot (another run may be creating or upgrading it)'
+                with advisory_lock(file, description=description, timeout=-1):
+                    template = chroot_template()
+                with advisory_lock(file, shared=True, description=description, timeout=-1):
+                    chroot_snapshot(template, chroot_root)
+            run(['tee', '-a', chroot_root + '/etc/pacman.conf'], sudo=True,
+                stdin='\n[autopkg]\nSigLevel = Never\nServer = file:///repo\n')
         yield ArchRoot(path)
         if isdir(chroot_root):
             chroot_cleanup(chroot_root)
-        if isdir(chroot_working):
-            chroot_cleanup(chroot_working)
+        for name in listdir(path):
+            if name.startswith('working') and isdir(join(path, name)):
+                chroot_cleanup(join(path, name))
+
+
+def chroot_template():
+    """ Creates the template chroot, or upgrades it if it has not been upgraded for AUTOPKG_CHROOT_REFRESH seconds.
+    :return: Path to the template chroot.
+    """
+    template = join(chroot_home, 'template')
+    stamp = join(chroot_home, 'template.stamp')
+    if not exists(stamp):
+        # No template, or an incomplete one.
+        if isdir(template):
+            chroot_cleanup(template)
+        run(['mkarchroot', template, 'base-devel'], capture=False)
+        Path(stamp).touch()
+    elif time() - getmtime(stamp) >= chroot_refresh_interval:
+        run(['arch-nspawn', template, 'pacman', '-Syu', '--noconfirm'], capture=False)
+        Path(stamp).touch()
+    return template
+
+
+def chroot_snapshot(source, destination):
+    """ Copies a chroot, using a btrfs snapshot if possible and a reflink copy otherwise.
+    :param source: Path to the chroot to copy.
+    :param destination: Path to the copy.
+    """
+    if is_btrfs(source) and run(['btrfs', 'subvolume', 'snapshot', source, destination], sudo=True,
+                                allow_error=True) is not None:
+        return
+    run(['cp', '-a', '--reflink=auto', source, destination], sudo=True)
+
+
+def is_btrfs(path):
+    """ :param path: The path.
+    :return: Whether the path is on btrfs or not.
+    """
+    return run(['stat', '-f', '-c', '%T', path], quiet=True).strip() == 'btrfs'
 
 
 def chroot_cleanup(path):
     """ Clears the specified chroot.
     :param path: Path to the chroot.
     """
-    if run(['stat', '-f', '-c', '%T', path], quiet=True).strip() == 'btrfs':
+    if is_btrfs(path):
         run(['btrfs', 'subvolume', 'delete', join(path, 'var', 'lib', 'machines')], sudo=True, allow_error=True)
         run(['btrfs', 'subvolume', 'delete', path], sudo=True, allow_error=True)
     else:
@@ -52,16 +116,18 @@ class ArchRoot:
     def __init__(self, path):
         """ :param ws: Path for the chroot. """
         self.path = path
-        repository_path = join(path, 'root', 'repo')
-        self.repository = Repository('autopkg', mkdir(repository_path, sudo=True), sudo=True)
+        # Kept outside of the chroot and bind-mounted read-only, so that it is not copied into each working copy.
+        self.repository = Repository('autopkg', mkdir(join(path, 'repo')))
 
-    def build(self, pkgbuild_dir):
+    def build(self, pkgbuild_dir, copy='working'):
         """ Build packages in chroot environment.
         :param pkgbuild_dir: The path to the directory where PKGBUILD resides.
+        :param copy: The name of the copy of the chroot to build in.
         """
         for i in range(num_retrials):
             try:
-                run(['makechrootpkg', '-c', '-u', '-l', 'working', '-r', self.path], cwd=pkgbuild_dir, capture=False)
+                run(['makechrootpkg', '-c', '-u', '-l', copy, '-r', self.path,
+                     '-D', '{}:/repo'.format(self.repository.directory)], cwd=pkgbuild_dir, capture=False)
                 return
             except CalledProcessError:
                 pass
@@ -94,31 +160,97 @@ def execute_plans_update(plans, repository):
 
 
 def do_build(plans, repository, chroot=None):
-    """ :param plans: Plans to execute.
+    """ Executes plans with up to AUTOPKG_JOBS builds at once. A plan starts as soon as all plans that build its
+    requisites are done, and is skipped if any of them has failed.
+    :param plans: Plans to execute.
     :param repository: The main repository.
     :param chroot: Chroot environment.
     """
     log(LogLevel.header, 'Build...')
-    for plan in plans:
-        if len(plan.build) == 0:
-            continue
-        try:
-            if plan.chroot:
-                for requisite in plan.requisites:
-                    chroot.repository.add(repository.find_package_file_path(requisite))
-            buildable = plan.buildable
-            with workspace() as pkgbuild_workspace:
+    plans = [plan for plan in plans if len(plan.build) > 0]
+    pkgname_to_index = {pkgname: index for index, plan in enumerate(plans) for pkgname in plan.build}
+    dependencies = [{pkgname_to_index[requisite] for requisite in plan.requisites
+                     if requisite in pkgname_to_index and pkgname_to_index[requisite] != index}
+                    for index, plan in enumerate(plans)]
+    # Each running build gets its own copy of the chroot.
+    copies = Queue()
+    for slot in range(num_jobs):
+        copies.put('working' if slot == 0 else 'working-{}'.format(slot))
+    repository_lock = Lock()
+    pending = list(range(len(plans)))
+    done = set()
+    failed = set()
+    future_to_index = dict()
+    with repository.transaction(), ThreadPoolExecutor(max_workers=num_jobs) as executor:
+        while len(pending) > 0 or len(future_to_index) > 0:
+            for index in list(pending):
+                if len(future_to_index) >= num_jobs:
+                    break
+                if dependencies[index] <= done:
+                    pending.remove(index)
+                    if len(dependencies[index] & failed) > 0:
+                        # Its requisites were never built, so neither is it. Nor are the plans that depend on it.
+                        log(LogLevel.error, 'Skipped building from {} since its requisites have failed to build',
+                            plans[index].buildable.source_reference)
+                        done.add(index)
+                        failed.add(index)
+                        continue
+                    future = executor.submit(execute_plan, plans[index], repository, chroot, copies, repository_lock)
+                    future_to_index[future] = index
+            finished, _ = wait(future_to_index, return_when=FIRST_COMPLETED)
+            for future in finished:
+                index = future_to_index.pop(future)
+                done.add(index)
+                if not future.result():
+                    failed.add(index)
+
+
+def execute_plan(plan, repository, chroot, copies, repository_lock):
+    """ :param plan: The plan to execute.
+    :param repository: The main repository.
+    :param chroot: Chroot environment.
+    :param copies: Queue of names of free chroot copies.
+    :param repository_lock: Lock that serializes access to the repositories.
+    :return: Whether the plan has been executed successfully or not.
+    """
+    try:
+        requisite_hashes = list()
+        if plan.chroot:
+            with repository_lock, span('link requisites', requisites=len(plan.requisites)):
+                chroot.repository.link(repository, plan.requisites)
+                requisite_hashes = [(requisite, repository.entry(requisite).fields['SHA256SUM'][0])
+                                    for requisite in plan.requisites]
+        buildable = plan.buildable
+        with workspace() as pkgbuild_workspace:
+            with span('write_pkgbuild_to', source=str(buildable.source_reference)):
                 pkgbuild_dir = buildable.write_pkgbuild_to(pkgbuild_workspace)
-                if plan.chroot:
-                    chroot.build(pkgbuild_dir)
-                else:
+            build_key = build_cache_key(pkgbuild_dir, requisite_hashes, plan.chroot)
+            if restore_build(build_key, pkgbuild_dir):
+                log(LogLevel.good, 'Reusing the cached build of {}', buildable.source_reference)
+            elif plan.chroot:
+                copy = copies.get()
+                try:
+                    with span('build', source=str(buildable.source_reference), copy=copy):
+                        chroot.build(pkgbuild_dir, copy)
+                finally:
+                    copies.put(copy)
+            else:
+                with span('build', source=str(buildable.source_reference)):
                     build(pkgbuild_dir)
+            pkgname_to_file_names = package_files(pkgbuild_dir)
+            store_build(build_key, [join(pkgbuild_dir, file_name) for file_names in pkgname_to_file_names.values()
+                                    for file_name in file_names])
+            with repository_lock:
                 for pkgname in plan.build:
-                    built_package_file = join(pkgbuild_dir, pick_package_file(pkgname, pkgbuild_dir))
-                    repository.add(built_package_file)
+                    built_package_file = join(pkgbuild_dir, pick_package_file(pkgname, pkgbuild_dir,
+                                                                              pkgname_to_file_names))
+                    with span('add', pkgname=pkgname):
+                        repository.add(built_package_file)
                     log(LogLevel.good, 'Successfully built {} from {}', pkgname, buildable.source_reference)
-        except BuildException:
-            log(LogLevel.error, 'Error while building from {}', plan.buildable.source_reference)
+        return True
+    except BuildException:
+        log(LogLevel.error, 'Error while building from {}', plan.buildable.source_reference)
+        return False
 
 
 def autoremovable_packages(plans, repository):
@@ -126,7 +258,7 @@ def autoremovable_packages(plans, repository):
     :param repository: The main repository.
     :return: The names of packages that can be auto-removed.
     """
-    needed = [pkgname for plan in plans for pkgname in plan.build + plan.keep]
+    needed = {pkgname for plan in plans for pkgname in plan.build + plan.keep}
     to_remove = list()
     for pkgname in repository.packages.keys():
         if pkgname not in needed:
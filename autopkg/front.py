@@ -6,6 +6,7 @@ from os.path import join
 from contextlib import contextmanager
 from enum import Enum
 from .utils import run_lock
+from .utils import LockTimeoutError
 from .utils import log
 from .utils import LogLevel
 from .utils import repository_home
@@ -15,16 +16,27 @@ from .utils import config
 from .utils import mkdir
 from .utils import dedup
 from .utils import write_autoremovable
+from .utils import trace_home
+from .utils import profile_path
 from .backends import git_backend
 from .backends import gshellext_backend
 from .backends import aur_backend
 from .backends import config_git_backend
+from .backends import git_sources
+from .metadata import log_metadata_statistics
 from .repository import Repository
 from .graph import build_dependency_graph
 from .plan import convert_graph_to_plans
 from .builder import execute_plans_update
 from .builder import execute_plans_autoremove
 from .builder import autoremovable_packages
+from .trace import tracing
+from .trace import trace_file_name
+from .trace import evict_traces
+from .trace import TRACE_HISTORY
+from .trace import span
+from .snapshot import save_snapshot
+from .snapshot import load_snapshot
 
 
 BACKENDS = [git_backend, gshellext_backend, aur_backend]
@@ -35,8 +47,8 @@ def unknown_command(command):
 
 
 @contextmanager
-def config_targets():
-    with config('targets') as config_data:
+def config_targets(shared=False):
+    with config('targets', shared=shared) as config_data:
         if config_data.json is None:
             config_data.json = []
         yield config_data
@@ -48,7 +60,7 @@ def do_targets(arguments):
     else:
         cmdlet = arguments[0]
     targets = arguments[1:]
-    with config_targets() as config_data:
+    with config_targets(shared=cmdlet == 'list') as config_data:
         if cmdlet == 'add':
             config_data.json = dedup(config_data.json + targets)
         elif cmdlet == 'remove':
@@ -70,8 +82,9 @@ def do_packages(arguments, repository):
         cmdlet = arguments[0]
     targets = arguments[1:]
     if cmdlet == 'add':
-        for target in targets:
-            repository.add(target)
+        with repository.transaction():
+            for target in targets:
+                repository.add(target)
     elif cmdlet == 'remove':
         for target in targets:
             repository.remove(target)
@@ -89,7 +102,7 @@ def do_git(arguments):
     else:
         cmdlet = arguments[0]
     targets = arguments[1:]
-    with config_git_backend() as config_data:
+    with config_git_backend(shared=cmdlet == 'list') as config_data:
         if cmdlet == 'add':
             repo_url = targets[0]
             path = targets[1] if len(targets) > 1 else ''
@@ -113,23 +126,45 @@ def do_git(arguments):
 
 
 def do_plans(repository):
-    with config_targets() as config_data:
-        log(LogLevel.header, 'Querying Backends...')
-        graph = build_dependency_graph(config_data.json, BACKENDS)
+    with config_targets(shared=True) as config_data:
+        targets = config_data.json
+    log(LogLevel.header, 'Querying Backends...')
+    with span('build_dependency_graph', profile=True):
+        graph = build_dependency_graph(targets, BACKENDS)
+    log_metadata_statistics()
+    with span('convert_graph_to_plans', profile=True):
         plans = convert_graph_to_plans(graph, repository)
-        # Now we can assure that the graph is acyclic (a 'tree')
-        log(LogLevel.header, 'Dependency Tree:')
-        for root_edge in graph:
-            log_graph(root_edge, repository, 0)
-        log(LogLevel.header, 'Plan:')
-        log_plans(plans)
-        to_remove = autoremovable_packages(plans, repository)
-        if len(to_remove) > 0:
-            log(LogLevel.header, 'Auto-removable Packages:')
-            for pkgname in to_remove:
-                log(LogLevel.info, ' - {}', pkgname)
-        write_autoremovable(to_remove)
-        return plans
+    # Now we can assure that the graph is acyclic (a 'tree')
+    log(LogLevel.header, 'Dependency Tree:')
+    log_graph(graph, repository)
+    save_snapshot(plans, targets, git_sources(), repository)
+    report_plans(plans, repository)
+    return plans
+
+
+def saved_or_new_plans(repository):
+    """ :param repository: The Repository.
+    :return: Plans saved by an earlier 'plan' if nothing they depend on has changed, or newly computed plans.
+    """
+    with config_targets(shared=True) as config_data:
+        targets = config_data.json
+    log(LogLevel.header, 'Checking the Saved Plan...')
+    plans = load_snapshot(targets, git_sources(), repository)
+    if plans is None:
+        return do_plans(repository)
+    report_plans(plans, repository)
+    return plans
+
+
+def report_plans(plans, repository):
+    log(LogLevel.header, 'Plan:')
+    log_plans(plans)
+    to_remove = autoremovable_packages(plans, repository)
+    if len(to_remove) > 0:
+        log(LogLevel.header, 'Auto-removable Packages:')
+        for pkgname in to_remove:
+            log(LogLevel.info, ' - {}', pkgname)
+    write_autoremovable(to_remove)
 
 
 class Transition(Enum):
@@ -147,24 +182,37 @@ TRANSITION_TO_COLOR = {Transition.keep: [],
                        Transition.remove: [31]}
 
 
-def log_graph(edge, repository, depth):
-    vertex = edge.vertex_to
-    if vertex is None:
-        return
-    buildable = vertex.buildable
-    package_info = buildable.package_info
-    source_reference = buildable.source_reference
-    pkgname = package_info.pkgname
-    if pkgname in repository.packages:
-        old = repository.packages[pkgname].version
-    else:
-        old = None
-    new = package_info.version
-    log_string = ' {}+ {} {} [{}] [{}]'.format(' ' * (depth * 2), pkgname, transition_string(old, new),
-                                               source_reference, edge.dependency_type.name)
-    log(LogLevel.info, log_string)
-    for edge in vertex.edges:
-        log_graph(edge, repository, depth + 1)
+def log_graph(root_edges, repository):
+    """ Logs the dependency tree. Dependencies of a package are shown only at its first appearance.
+    :param root_edges: List of DependencyEdges from the root vertex of the graph.
+    :param repository: The Repository.
+    """
+    shown = set()
+    stack = [(edge, 0) for edge in reversed(root_edges)]
+    while len(stack) > 0:
+        edge, depth = stack.pop()
+        vertex = edge.vertex_to
+        if vertex is None:
+            continue
+        buildable = vertex.buildable
+        package_info = buildable.package_info
+        source_reference = buildable.source_reference
+        pkgname = package_info.pkgname
+        if pkgname in repository.packages:
+            old = repository.packages[pkgname].version
+        else:
+            old = None
+        new = package_info.version
+        log_string = ' {}+ {} {} [{}] [{}]'.format(' ' * (depth * 2), pkgname, transition_string(old, new),
+                                                   source_reference, edge.dependency_type.name)
+        if vertex in shown:
+            if len(vertex.edges) > 0:
+                log_string += ' \033[2m(…)\033[0m'
+            log(LogLevel.info, log_string)
+            continue
+        log(LogLevel.info, log_string)
+        shown.add(vertex)
+        stack.extend((edge, depth + 1) for edge in reversed(vertex.edges))
 
 
 def transition_string(old, new):
@@ -224,18 +272,78 @@ Environment variables:
  - AUTOPKG_HOME
  - AUTOPKG_REPO_NAME
  - AUTOPKG_KEY: GPG key to sign packages and the repository.
- - AUTOPKG_RETRY: The number of retrials in build packages in chroot environment.'''.format(name))
+ - AUTOPKG_RETRY: The number of retrials in build packages in chroot environment.
+ - AUTOPKG_JOBS: The number of packages to build at once.
+ - AUTOPKG_CHROOT_REFRESH: Seconds between upgrades of the template chroot.
+ - AUTOPKG_CACHE_TTL: Seconds to trust cached backend metadata without checking upstream (300 by default). 0 to
+   always check.
+ - AUTOPKG_AUR_MIRROR_CAPACITY: The number of AUR package repositories to keep mirrored locally.
+ - AUTOPKG_BUILD_CACHE_SIZE: MiB of built packages to keep for reuse across runs and repositories. 0 to disable.
+ - AUTOPKG_LOG_LEVEL: The most verbose level written to the log file (error, warn, info, header, good, fine, debug).
+ - AUTOPKG_LOG_FORMAT: Format of the log file ('text' or 'json' for JSON lines).
+ - AUTOPKG_LOG_FLUSH_INTERVAL: Seconds between flushes of the log file. Non-positive to flush every entry.
+ - AUTOPKG_PROFILE: Path to dump cProfile stats of the Python-side phases to.
+ - AUTOPKG_LOCK_TIMEOUT: Seconds to wait for locks held by other runs. Negative to wait forever.'''.format(name))
+
+
+def changes_repository(arguments):
+    """ :param arguments: The command line arguments.
+    :return: Whether the command changes the repository, so that it excludes other such commands for the whole run.
+    """
+    for index, cmdlet in enumerate(arguments):
+        if cmdlet in ['update', 'autoremove']:
+            return True
+        elif cmdlet == 'packages':
+            return len(arguments) > index + 1 and arguments[index + 1] in ['add', 'remove']
+        elif cmdlet != 'plan':
+            return False
+    return False
+
+
+def lists_only(arguments):
+    """ :param arguments: The command line arguments.
+    :return: Whether the command only lists something or shows help, which is not worth a trace.
+    """
+    if len(arguments) == 0 or arguments[0] == '--help':
+        return True
+    return arguments[0] in ['targets', 'packages', 'git'] and (len(arguments) == 1 or arguments[1] == 'list')
 
 
 def front(name, arguments):
-    with run_lock():
+    try:
+        if changes_repository(arguments):
+            with run_lock():
+                do_front(name, arguments)
+        else:
+            do_front(name, arguments)
+    except LockTimeoutError as e:
+        log(LogLevel.error, str(e))
+        sys.exit(1)
+
+
+def do_front(name, arguments):
+    trace_path = None
+    if not lists_only(arguments):
+        evict_traces(mkdir(trace_home), repository_name, TRACE_HISTORY - 1)
+        trace_path = join(trace_home, trace_file_name(repository_name))
+    with tracing(trace_path, profile_path):
         log(LogLevel.debug, 'arguments: {}', arguments)
         log(LogLevel.debug, 'AUTOPKG_HOME: {}', environ.get('AUTOPKG_HOME', None))
         log(LogLevel.debug, 'AUTOPKG_REPO_HOME: {}', environ.get('AUTOPKG_REPO_HOME', None))
         log(LogLevel.debug, 'AUTOPKG_KEY: {}', environ.get('AUTOPKG_KEY', None))
         log(LogLevel.debug, 'AUTOPKG_RETRY: {}', environ.get('AUTOPKG_RETRY', None))
+        log(LogLevel.debug, 'AUTOPKG_JOBS: {}', environ.get('AUTOPKG_JOBS', None))
+        log(LogLevel.debug, 'AUTOPKG_CHROOT_REFRESH: {}', environ.get('AUTOPKG_CHROOT_REFRESH', None))
+        log(LogLevel.debug, 'AUTOPKG_CACHE_TTL: {}', environ.get('AUTOPKG_CACHE_TTL', None))
+        log(LogLevel.debug, 'AUTOPKG_AUR_MIRROR_CAPACITY: {}', environ.get('AUTOPKG_AUR_MIRROR_CAPACITY', None))
+        log(LogLevel.debug, 'AUTOPKG_BUILD_CACHE_SIZE: {}', environ.get('AUTOPKG_BUILD_CACHE_SIZE', None))
+        log(LogLevel.debug, 'AUTOPKG_LOG_LEVEL: {}', environ.get('AUTOPKG_LOG_LEVEL', None))
+        log(LogLevel.debug, 'AUTOPKG_LOG_FORMAT: {}', environ.get('AUTOPKG_LOG_FORMAT', None))
+        log(LogLevel.debug, 'AUTOPKG_LOG_FLUSH_INTERVAL: {}', environ.get('AUTOPKG_LOG_FLUSH_INTERVAL', None))
+        log(LogLevel.debug, 'AUTOPKG_PROFILE: {}', environ.get('AUTOPKG_PROFILE', None))
+        log(LogLevel.debug, 'AUTOPKG_LOCK_TIMEOUT: {}', environ.get('AUTOPKG_LOCK_TIMEOUT', None))
         repository = Repository(repository_name, mkdir(join(repository_home, repository_name)), sign_key=sign_key,
-                                sudo=False)
+                                sudo=False, lock_name=repository_name + '.db')
         plans = None
         for index, cmdlet in enumerate(arguments):
             if cmdlet == 'targets':
@@ -249,12 +357,14 @@ def front(name, arguments):
                 break
             elif cmdlet == 'update':
                 if plans is None:
-                    plans = do_plans(repository)
-                execute_plans_update(plans, repository)
+                    plans = saved_or_new_plans(repository)
+                with span('update'):
+                    execute_plans_update(plans, repository)
             elif cmdlet == 'autoremove':
                 if plans is None:
-                    plans = do_plans(repository)
-                execute_plans_autoremove(plans, repository)
+                    plans = saved_or_new_plans(repository)
+                with span('autoremove'):
+                    execute_plans_autoremove(plans, repository)
             elif cmdlet == 'plan':
                 if plans is None:
                     plans = do_plans(repository)
@@ -1,7 +1,10 @@
 #!/usr/bin/python3
 
+from collections import OrderedDict
 from enum import Enum
+from sys import intern
 from .utils import dedup
+from .trace import span
 
 
 class DependencyType(Enum):
@@ -16,6 +19,8 @@ class DependencyType(Enum):
 class DependencyVertex:
     """ Represents dependency node. """
 
+    __slots__ = ('buildable', 'edges')
+
     def __init__(self, buildable, edges):
         """ :param buildable: The corresponding buildable from the backend.
         :param edges: List of edges that represents dependency for running or building this package.
@@ -56,11 +61,13 @@ class DependencyVertex:
 class DependencyEdge:
     """ Represents dependency relationship. """
 
+    __slots__ = ('pkgname', 'dependency_type', 'is_resolved', 'vertex_to')
+
     def __init__(self, pkgname, dependency_type):
         """ :param pkgname: The name of package to depend on. CASE SENSITIVE.
         :param dependency_type: The type of dependency.
         """
-        self.pkgname = pkgname
+        self.pkgname = intern(pkgname)
         self.dependency_type = dependency_type
         self.is_resolved = False
         self.vertex_to = None
@@ -85,34 +92,30 @@ class DependencyEdge:
         self.is_resolved = True
 
 
-class CaseInsensitiveStringList:
-    """ A list of strings that ignores case, except for 'get'. """
+class CaseInsensitiveStringSet:
+    """ An ordered set of strings that ignores case, except for 'get'.
+    Strings that differ only in case are merged into the first one.
+    """
 
-    def __init__(self, lst):
-        self.list_original = lst
-        self.list_lower = [string.lower() for string in lst]
-        if len(self.list_lower) != len(set(self.list_lower)):
-            raise Exception('Cannot build case insensitive list with unique elements.')
+    def __init__(self, strings):
+        self.lower_to_original = OrderedDict()
+        for string in strings:
+            self.lower_to_original.setdefault(string.lower(), string)
 
     def __contains__(self, item):
-        return item.lower() in self.list_lower
+        return item.lower() in self.lower_to_original
 
     def __len__(self):
-        return len(self.list_original)
+        return len(self.lower_to_original)
 
     def get(self):
-        return self.list_original
+        return list(self.lower_to_original.values())
 
     def get_lower(self):
-        return self.list_lower
+        return list(self.lower_to_original.keys())
 
     def remove(self, string):
-        try:
-            index = self.list_lower.index(string.lower())
-            del self.list_original[index]
-            del self.list_lower[index]
-        except ValueError:
-            pass
+        self.lower_to_original.pop(string.lower(), None)
 
     def remove_strings(self, strings):
         for string in strings:
@@ -125,10 +128,11 @@ def query_by_pkgnames(pkgnames, backends):
     :param backends: List of backends, sorted by priority.
     :return: List of the found buildables.
     """
-    names = CaseInsensitiveStringList(dedup(pkgnames))
+    names = CaseInsensitiveStringSet(dedup(pkgnames))
     buildables = list()
     for backend in backends:
-        new_buildables = backend(names.get())
+        with span(backend.__name__, category='backend', profile=True, pkgnames=len(names)):
+            new_buildables = backend(names.get())
         buildables += new_buildables
         names.remove_strings([buildable.package_info.pkgname for buildable in new_buildables])
     return buildables
@@ -141,10 +145,10 @@ def build_dependency_graph(pkgnames, backends):
     :return: List of DependencyEdges from the root vertex of the graph.
     """
     root_edges = [DependencyEdge(pkgname, DependencyType.explicit) for pkgname in set(pkgnames)]
-    pkgname_to_vertex = dict()
+    pkgname_to_vertex = dict()  # a map from lowercased name of a package to its vertex, shared across rounds
     unresolved_edges = list(root_edges)
     while len(unresolved_edges) > 0:
-        unresolved_pkgnames = CaseInsensitiveStringList(
+        unresolved_pkgnames = CaseInsensitiveStringSet(
             dedup([unresolved_edge.pkgname for unresolved_edge in unresolved_edges]))
         new_vertices = list()
         for buildable in query_by_pkgnames(unresolved_pkgnames.get(), backends):
@@ -155,7 +159,7 @@ def build_dependency_graph(pkgnames, backends):
             unresolved_pkgnames.remove(buildable.package_info.pkgname)
             new_vertex = DependencyVertex.from_buildable(buildable)
             new_vertices.append(new_vertex)
-            pkgname_to_vertex[buildable.package_info.pkgname] = new_vertex
+            pkgname_to_vertex[buildable.package_info.pkgname.lower()] = new_vertex
         for unresolved_pkgname in unresolved_pkgnames.get_lower():
             # We have tried to find BuildItem for unresolved_pkgname, but it was unable to obtain.
             # Maybe it's from official repositories.
@@ -0,0 +1,109 @@
+#!/usr/bin/python3
+
+from time import time
+from .utils import cache
+from .utils import metadata_ttl
+from .utils import log
+from .utils import LogLevel
+
+
+class MetadataCache:
+    """ Persistent cache of metadata obtained by a backend, with a freshness token for each entry. """
+
+    def __init__(self, name, ttl=metadata_ttl):
+        """ :param name: The name of the cache.
+        :param ttl: Seconds during which an entry is used without checking its freshness token.
+        """
+        self.name = name
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        with cache('metadata_' + name) as cache_data:
+            self.entries = cache_data.json if cache_data.json is not None else dict()
+        self.updated = dict()
+
+    def __str__(self):
+        return 'Metadata cache {} ({} hit(s), {} miss(es))'.format(self.name, self.hits, self.misses)
+
+    def __repr__(self):
+        return 'MetadataCache({})'.format(repr(self.name))
+
+    def lookup(self, key):
+        """ :param key: The key.
+        :return: The cached data if it was stored within TTL. None otherwise.
+        """
+        entry = self.entries.get(key)
+        if entry is None or time() - entry['time'] >= self.ttl:
+            return None
+        self.hits += 1
+        return entry['data']
+
+    def cached(self, key):
+        """ :param key: The key.
+        :return: The cached data regardless of its age. None if not cached.
+        """
+        entry = self.entries.get(key)
+        return entry['data'] if entry is not None else None
+
+    def token(self, key):
+        """ :param key: The key.
+        :return: The freshness token of the cached data regardless of its age. None if not cached.
+        """
+        entry = self.entries.get(key)
+        return entry['token'] if entry is not None else None
+
+    def validate(self, key, token):
+        """ :param key: The key.
+        :param token: The current freshness token of the source.
+        :return: The cached data if it was stored with the same token. None otherwise.
+        """
+        entry = self.entries.get(key)
+        hit = entry is not None and entry['token'] == token
+        self.record(hit)
+        return entry['data'] if hit else None
+
+    def record(self, hit):
+        """ Counts a hit or a miss that the backend has found out by itself, e.g. with a conditional request.
+        :param hit: Whether the cached data has been still valid or not.
+        """
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+
+    def put(self, key, token, data):
+        """ :param key: The key.
+        :param token: The freshness token of the source from which the data is obtained.
+        :param data: JSON-serializable data.
+        """
+        entry = {'token': token, 'time': time(), 'data': data}
+        self.entries[key] = entry
+        self.updated[key] = entry
+
+    def save(self):
+        """ Writes updated entries to the disk. """
+        if len(self.updated) == 0:
+            return
+        with cache('metadata_' + self.name) as cache_data:
+            if cache_data.json is None:
+                cache_data.json = dict()
+            cache_data.json.update(self.updated)
+        self.updated = dict()
+
+
+metadata_caches = dict()
+
+
+def metadata_cache(name):
+    """ :param name: The name of the cache.
+    :return: The shared MetadataCache with the name.
+    """
+    if name not in metadata_caches:
+        metadata_caches[name] = MetadataCache(name)
+    return metadata_caches[name]
+
+
+def log_metadata_statistics():
+    """ Logs hit and miss counts of the metadata caches. """
+    for metadata in metadata_caches.values():
+        log(LogLevel.fine, str(metadata))
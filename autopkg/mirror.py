@@ -0,0 +1,155 @@
+#!/usr/bin/python3
+
+from concurrent.futures import ThreadPoolExecutor
+from fcntl import flock
+from fcntl import LOCK_EX
+from fcntl import LOCK_NB
+from hashlib import sha1
+from os import listdir
+from os import rename
+from os import utime
+from os.path import join
+from os.path import basename
+from os.path import exists
+from os.path import getmtime
+from .utils import run
+from .utils import mkdir
+from .utils import advisory_lock
+from .utils import mirror_home
+from .utils import aur_mirror_capacity
+
+
+git_mirror_home = join(mirror_home, 'git')
+aur_mirror_home = join(mirror_home, 'aur')
+AUR_GIT_URL_FORMAT = 'https://aur.archlinux.org/{}.git'
+updated_mirrors = set()
+LS_REMOTE_WORKERS = 8
+
+
+def git_mirror(repo_url):
+    """ Creates the bare mirror of a repository, or updates it with 'git fetch' at most once per process.
+    :param repo_url: The URL of the repository.
+    :return: Path to the mirror.
+    """
+    path = join(mkdir(git_mirror_home), sha1(repo_url.encode()).hexdigest())
+    if path in updated_mirrors:
+        return path
+    with open(path + '.lock', mode='a') as file:
+        with advisory_lock(file):
+            if exists(path):
+                run(['git', 'fetch', '--prune', 'origin'], cwd=path, capture=False)
+            else:
+                # Clone aside so that an interrupted clone does not leave a broken mirror behind.
+                temporary_path = path + '.tmp'
+                run(['rm', '-rf', temporary_path], quiet=True)
+                run(['git', 'clone', '--mirror', repo_url, temporary_path], capture=False)
+                rename(temporary_path, path)
+    updated_mirrors.add(path)
+    return path
+
+
+def aur_mirror(pkgbase, url_format=AUR_GIT_URL_FORMAT):
+    """ Creates the shallow bare mirror of an AUR package, or updates it with a shallow fetch at most once per process.
+    The least recently used mirrors are evicted to keep at most AUTOPKG_AUR_MIRROR_CAPACITY mirrors.
+    :param pkgbase: The pkgbase of the AUR package.
+    :param url_format: Format string for the URL of the repository.
+    :return: Path to the mirror.
+    """
+    path = join(mkdir(aur_mirror_home), pkgbase)
+    if path in updated_mirrors:
+        return path
+    # Each mirror is fetched under its own lock, so that parallel builds fetch different packages at the same time.
+    with open(aur_mirror_lock_path(pkgbase), mode='a') as file:
+        with advisory_lock(file):
+            if exists(path):
+                run(['git', 'fetch', '--depth', '1', 'origin', '+refs/heads/master:refs/heads/master'], cwd=path,
+                    capture=False)
+            else:
+                temporary_path = path + '.tmp'
+                run(['rm', '-rf', temporary_path], quiet=True)
+                run(['git', 'clone', '--bare', '--depth', '1', url_format.format(pkgbase), temporary_path],
+                    capture=False)
+                rename(temporary_path, path)
+            utime(path)
+    with open(join(aur_mirror_home, '.lock'), mode='a') as file:
+        with advisory_lock(file):
+            evict_aur_mirrors(aur_mirror_capacity)
+    updated_mirrors.add(path)
+    return path
+
+
+def aur_mirror_lock_path(pkgbase):
+    """ :param pkgbase: The pkgbase of the AUR package.
+    :return: Path to the lock file of the mirror. Hidden, so that it is not taken for a mirror.
+    """
+    return join(aur_mirror_home, '.{}.lock'.format(pkgbase))
+
+
+def evict_aur_mirrors(capacity):
+    """ Removes the least recently used AUR mirrors. Mirrors being fetched by other runs are kept, since they are
+    about to be the most recently used ones.
+    :param capacity: The number of mirrors to keep.
+    """
+    paths = [join(aur_mirror_home, name) for name in listdir(aur_mirror_home)
+             if not name.startswith('.') and not name.endswith('.tmp')]
+    paths.sort(key=getmtime, reverse=True)
+    for path in paths[capacity:]:
+        with open(aur_mirror_lock_path(basename(path)), mode='a') as file:
+            try:
+                flock(file, LOCK_EX | LOCK_NB)
+            except BlockingIOError:
+                continue
+            run(['rm', '-rf', path], quiet=True)
+
+
+def mirror_commit(mirror, revision):
+    """ :param mirror: Path to the mirror.
+    :param revision: Branch, tag or commit.
+    :return: The commit id of the revision.
+    """
+    return run(['git', 'rev-parse', '--verify', revision + '^{commit}'], cwd=mirror, quiet=True).strip()
+
+
+def mirror_checkout(mirror, revision, path, shared=True):
+    """ Materializes a revision of a mirror locally.
+    :param mirror: Path to the mirror.
+    :param revision: Branch, tag or commit.
+    :param path: Path to an empty directory for the working tree.
+    :param shared: Whether to borrow objects from the mirror, or to hardlink them so that the working tree
+    survives eviction of the mirror.
+    :return: The path.
+    """
+    run(['git', 'clone', '--quiet', '--shared' if shared else '--local', '--no-checkout', mirror, path], quiet=True)
+    run(['git', 'checkout', '--quiet', revision], cwd=path, quiet=True)
+    return path
+
+
+def remote_refs(repo_urls):
+    """ Lists refs of remote repositories with 'git ls-remote', concurrently.
+    :param repo_urls: The URLs of the repositories.
+    :return: Dictionary from the URL of each repository to a dictionary from ref name to commit id.
+    """
+    if len(repo_urls) == 0:
+        return dict()
+    with ThreadPoolExecutor(max_workers=min(LS_REMOTE_WORKERS, len(repo_urls))) as executor:
+        outputs = list(executor.map(lambda repo_url: run(['git', 'ls-remote', repo_url], allow_error=True),
+                                    repo_urls))
+    repo_url_to_refs = dict()
+    for repo_url, output in zip(repo_urls, outputs):
+        refs = dict()
+        for line in (output or '').splitlines():
+            commit, _, ref = line.partition('\t')
+            refs[ref] = commit
+        repo_url_to_refs[repo_url] = refs
+    return repo_url_to_refs
+
+
+def remote_commit(refs, revision):
+    """ :param refs: Dictionary from ref name to commit id, as returned by remote_refs.
+    :param revision: Branch or tag.
+    :return: The commit id of the revision. None if it is not an advertised ref.
+    """
+    for ref in [revision, 'refs/tags/{}^{{}}'.format(revision), 'refs/tags/' + revision, 'refs/heads/' + revision]:
+        if ref in refs:
+            return refs[ref]
+    return None
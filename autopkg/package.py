@@ -4,30 +4,23 @@ from os import listdir
 from os.path import basename
 from os.path import join
 from os.path import isfile
-from re import escape
-from re import match
-from .utils import run
+from re import compile as re_compile
+from functools import lru_cache
+from sys import intern
 
 
 class PackageTinyInfo:
     """ A reference that represents a particular package. """
 
+    __slots__ = ('name', 'version')
+
     def __init__(self, name, version):
         """ :param name: The pkgname of this package.
         :param version: The package version.
         """
-        self.name = name
+        self.name = intern(name)
         self.version = Version(version) if type(version) is str else version
 
-    @classmethod
-    def from_repodb_directory_name(cls, directory_name):
-        """ Obtains package reference from a directory name in repository db.
-        :param directory_name: The directory name.
-        :return: The package reference.
-        """
-        split = directory_name.split('-')
-        return cls('-'.join(split[:-2]), '-'.join(split[-2:]))
-
     @classmethod
     def from_package_file_path(cls, path):
         """ Obtains package reference from the path to a package file.
@@ -46,23 +39,67 @@ class PackageTinyInfo:
         return '\'' + self.__str__() + '\''
 
 
-def pick_package_file(pkgname, directory):
+PACKAGE_FILE_PATTERN = re_compile('^(.+)-(?:[0-9]+:)?[A-Za-z0-9_.@+~]+-[A-Za-z0-9_.@+]+-[A-Za-z0-9_.@+]+'
+                                  '\\.pkg\\.tar(?:\\.(?:gz|bz2|xz|zst|lrz|lzo|lz4|lz|Z))?$')
+
+
+def package_files(directory):
+    """ Scans a directory for package files of any PKGEXT.
+    :param directory: The directory.
+    :return: Dictionary from the name of each package to the list of the names of its package files.
+    """
+    pkgname_to_file_names = dict()
+    for file_name in listdir(directory):
+        matched = PACKAGE_FILE_PATTERN.match(file_name)
+        if matched and isfile(join(directory, file_name)):
+            pkgname_to_file_names.setdefault(matched.group(1), list()).append(file_name)
+    return pkgname_to_file_names
+
+
+def pick_package_file(pkgname, directory, pkgname_to_file_names=None):
     """ :param pkgname: The name of the package.
     :param directory: The directory.
+    :param pkgname_to_file_names: Result of package_files for the directory, if already scanned.
     :return: The name of the package file in the directory.
     """
-    pattern = '^{}-([0-9]+:)?[a-z0-9_.@+]+-[a-z0-9_.@+]+-[a-z0-9_.@+]+\.pkg\.tar\.xz$'.format(escape(pkgname))
-    matched = [file_name for file_name in listdir(directory) if isfile(join(directory, file_name))
-               and match(pattern, file_name)]
+    if pkgname_to_file_names is None:
+        pkgname_to_file_names = package_files(directory)
+    matched = pkgname_to_file_names.get(pkgname, list())
     if len(matched) != 1:
         raise Exception('The number of picked package file for {} at {}: {}'.format(pkgname, directory, len(matched)))
     return matched[0]
 
 
+class PackageFile:
+    """ A package file in a repository. """
+
+    def __init__(self, path, signed, size):
+        """ :param path: The path to the package file.
+        :param signed: Whether the detached signature exists or not.
+        :param size: The size of the package file in bytes.
+        """
+        self.path = path
+        self.signed = signed
+        self.size = size
+
+    @property
+    def signature_path(self):
+        """ :return: The path to the detached signature. None if not signed. """
+        return self.path + '.sig' if self.signed else None
+
+    def __str__(self):
+        return self.path
+
+    def __repr__(self):
+        return 'PackageFile({}, {}, {})'.format(repr(self.path), repr(self.signed), repr(self.size))
+
+
 class PackageInfo:
     """ Subset of PKGBUILD. """
 
-    def __init__(self, pkgname, version, pkgbase=None, depends=[], makedepends=[], checkdepends=[]):
+    __slots__ = ('pkgname', 'version', 'pkgbase', 'depends', 'makedepends', 'checkdepends')
+
+    def __init__(self, pkgname, version, pkgbase=None, depends=None, makedepends=None, checkdepends=None):
         """ :param pkgname: The name of this package.
         :param version: The version.
         :param pkgbase: The pkgbase.
@@ -70,26 +107,40 @@ class PackageInfo:
         :param makedepends: List of names of packages this package depends on for building.
         :param checkdepends: List of names of packages this package depends on for build-time checking.
         """
-        self.pkgname = pkgname
+        self.pkgname = intern(pkgname)
         self.version = Version(version) if type(version) is str else version
-        self.pkgbase = pkgbase if pkgbase is not None else pkgname
-        self.depends = depends
-        self.makedepends = makedepends
-        self.checkdepends = checkdepends
-        self.tiny_info = PackageTinyInfo(pkgname, version)
+        self.pkgbase = intern(pkgbase) if pkgbase is not None else self.pkgname
+        self.depends = [intern(dependency) for dependency in depends] if depends else []
+        self.makedepends = [intern(dependency) for dependency in makedepends] if makedepends else []
+        self.checkdepends = [intern(dependency) for dependency in checkdepends] if checkdepends else []
+
+    @classmethod
+    def from_json(cls, json):
+        """ :param json: JSON representation from to_json.
+        :return: The PackageInfo.
+        """
+        return cls(json['pkgname'], json['version'], pkgbase=json['pkgbase'], depends=json['depends'],
+                   makedepends=json['makedepends'], checkdepends=json['checkdepends'])
+
+    def to_json(self):
+        """ :return: JSON representation of this PackageInfo. """
+        return {'pkgname': self.pkgname, 'version': str(self.version), 'pkgbase': self.pkgbase,
+                'depends': self.depends, 'makedepends': self.makedepends, 'checkdepends': self.checkdepends}
 
     def __str__(self):
         """ :return: Representation of this package reference. """
-        return str(self.tiny_info)
+        return '{} ({})'.format(self.pkgname, self.version)
 
     def __repr__(self):
         """ :return: Formal representation of this package reference. """
-        return repr(self.tiny_info)
+        return '\'' + self.__str__() + '\''
 
 
 class Version:
     """ Represents package version, including pkgver, pkgrel, and epoch. """
 
+    __slots__ = ('version',)
+
     def __init__(self, version):
         """ :param version: A string that represents the version. """
         self.version = version
@@ -107,11 +158,23 @@ class Version:
         """ :return: Formal representation of the version. """
         return self.version.__repr__()
 
+    @property
+    def key(self):
+        """ :return: Parsed form of this version, cached per version string. See parse_version. """
+        return parse_version(self.version)
+
     def cmp(self, other):
         """ :param other: The other version.
         :return: A negative integer if self < other, zero if self == other, a positive integer if self > other.
         """
-        return int(run(['vercmp', str(self.version), str(other.version)], quiet=True))
+        return vercmp(self.key, other.key)
+
+    def __hash__(self):
+        """ :return: Hash value, consistent with __eq__.
+        pkgrel does not take part since a version without pkgrel equals any version with the same pkgver.
+        """
+        epoch, pkgver, pkgrel = self.key
+        return hash((epoch, pkgver))
 
     def __eq__(self, other):
         """ :param other: The other version.
@@ -148,3 +211,95 @@ class Version:
         :return: True if and only if self >= other.
         """
         return self.cmp(other) >= 0
+
+
+VERSION_SEGMENT_PATTERN = re_compile('([^0-9A-Za-z]*)(?:([0-9]+)|([A-Za-z]+))')
+VERSION_EPOCH_PATTERN = re_compile('([0-9]*):')
+
+
+@lru_cache(maxsize=None)
+def parse_version(version):
+    """ Splits a version string into epoch, pkgver and pkgrel, following parseEVR() of libalpm.
+    :param version: The version string.
+    :return: Tuple of the epoch as an integer, the parsed pkgver, and the parsed pkgrel (None if absent).
+    """
+    matched = VERSION_EPOCH_PATTERN.match(version)
+    if matched:
+        epoch = int(matched.group(1) or 0)
+        version = version[matched.end():]
+    else:
+        epoch = 0
+    pkgver, dash, pkgrel = version.rpartition('-')
+    if not dash:
+        return epoch, parse_version_segments(pkgrel), None
+    return epoch, parse_version_segments(pkgver), parse_version_segments(pkgrel)
+
+
+def parse_version_segments(string):
+    """ :param string: pkgver or pkgrel.
+    :return: Tuple of (segments, has trailing separator), where each segment is a tuple of (the length of separator
+    ahead of the segment, whether the segment is numeric, the value of the segment).
+    """
+    segments = list()
+    end = 0
+    for matched in VERSION_SEGMENT_PATTERN.finditer(string):
+        separator, numeric, alpha = matched.groups()
+        if numeric is not None:
+            segments.append((len(separator), True, int(numeric)))
+        else:
+            segments.append((len(separator), False, alpha))
+        end = matched.end()
+    return tuple(segments), end < len(string)
+
+
+def vercmp(a, b):
+    """ In-process equivalent of vercmp(8).
+    :param a: Parsed version (see parse_version).
+    :param b: Parsed version (see parse_version).
+    :return: A negative integer if a < b, zero if a == b, a positive integer if a > b.
+    """
+    epoch_a, pkgver_a, pkgrel_a = a
+    epoch_b, pkgver_b, pkgrel_b = b
+    if epoch_a != epoch_b:
+        return -1 if epoch_a < epoch_b else 1
+    ret = rpmvercmp(pkgver_a, pkgver_b)
+    if ret == 0 and pkgrel_a is not None and pkgrel_b is not None:
+        ret = rpmvercmp(pkgrel_a, pkgrel_b)
+    return ret
+
+
+def rpmvercmp(a, b):
+    """ Port of rpmvercmp() of libalpm.
+    :param a: Parsed pkgver or pkgrel (see parse_version_segments).
+    :param b: Parsed pkgver or pkgrel (see parse_version_segments).
+    :return: -1 if a < b, 0 if a == b, 1 if a > b.
+    """
+    segments_a, trailing_a = a
+    segments_b, trailing_b = b
+    for (separator_a, numeric_a, value_a), (separator_b, numeric_b, value_b) in zip(segments_a, segments_b):
+        if separator_a != separator_b:
+            return -1 if separator_a < separator_b else 1
+        if numeric_a != numeric_b:
+            # Numeric segments are always newer than alpha segments.
+            return 1 if numeric_a else -1
+        if value_a != value_b:
+            return -1 if value_a < value_b else 1
+    if len(segments_a) == len(segments_b):
+        if trailing_a == trailing_b:
+            return 0
+        return 1 if trailing_a else -1
+    if len(segments_a) < len(segments_b):
+        return compare_exhausted(trailing_a, segments_b[len(segments_a)])
+    return -compare_exhausted(trailing_b, segments_a[len(segments_b)])
+
+
+def compare_exhausted(trailing, segment):
+    """ :param trailing: Whether the exhausted version ends with a separator.
+    :param segment: The next segment of the other version.
+    :return: -1 if the exhausted version is older than the other, 1 otherwise.
+    """
+    separator, numeric, value = segment
+    if trailing:
+        return -1 if numeric else 1
+    # An alpha segment attached right after the last common segment (like '1.0a' against '1.0') is a pre-release.
+    return 1 if not numeric and separator == 0 else -1
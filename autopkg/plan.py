@@ -3,6 +3,7 @@
 from .utils import log
 from .utils import LogLevel
 from .utils import dedup
+from .backends import buildable_from_json
 
 
 class Plan:
@@ -18,26 +19,30 @@ class Plan:
         self.keep = []
 
     @classmethod
-    def from_buildable(cls, buildable, plans):
+    def from_buildable(cls, buildable, index):
         """ :param buildable: The Buildable from backend.
-        :param plans: The plans to be executed ahead of this plan.
+        :param index: The PlanIndex of the plans to be executed ahead of this plan.
         :return: Plan to build this Buildable.
         """
         package_info = buildable.package_info
         dependencies = dedup(package_info.depends + package_info.makedepends + package_info.checkdepends)
-        pkgname_to_plan = dict()  # a map from name of a package to the plan that resolves the package
-        for plan in plans:
-            for pkgname in plan.build + plan.keep:
-                pkgname_to_plan[pkgname] = plan
-        return cls(buildable, dedup([resolved_dependency for pkgname in dependencies for resolved_dependency in cls.track_dependency(pkgname, pkgname_to_plan)]))
+        return cls(buildable, dedup([resolved_dependency for pkgname in dependencies
+                                     for resolved_dependency in index.closure(pkgname)]))
 
     @classmethod
-    def track_dependency(cls, dependency, pkgname_to_plan):
-        if dependency in pkgname_to_plan:
-            plan = pkgname_to_plan[dependency]
-            return [dependency] + dedup([resolved_dependency for pkgname in plan.requisites for resolved_dependency in cls.track_dependency(pkgname, pkgname_to_plan)])
-        else:
-            return []
+    def from_json(cls, json):
+        """ :param json: JSON representation from to_json.
+        :return: The Plan.
+        """
+        plan = cls(buildable_from_json(json['buildable']), json['requisites'])
+        plan.build = json['build']
+        plan.keep = json['keep']
+        return plan
+
+    def to_json(self):
+        """ :return: JSON representation of this Plan. """
+        return {'buildable': self.buildable.to_json(), 'requisites': self.requisites, 'build': self.build,
+                'keep': self.keep}
 
     def __str__(self):
         return '{}→[{}]'.format(self.buildable.source_reference, ', '.join(self.build + self.keep))
@@ -65,12 +70,42 @@ class Plan:
         :param pkgname: The name of the package.
         :param repository: The Repository.
         """
-        if pkgname in repository.packages and repository.packages[pkgname] >= self.buildable.package_info.version:
+        package = repository.packages.get(pkgname)
+        if package is not None and package.version >= self.buildable.package_info.version:
             self.add_keep(pkgname)
         else:
             self.add_build(pkgname)
 
 
+class PlanIndex:
+    """ Incremental index from the name of each package to the plan that resolves it. """
+
+    def __init__(self):
+        self.pkgname_to_plan = dict()
+        self.closures = dict()  # a map from name of a package to the memoized closure of its requisites
+
+    def add(self, pkgname, plan):
+        """ :param pkgname: The name of the package.
+        :param plan: The plan that resolves the package.
+        """
+        self.pkgname_to_plan[pkgname] = plan
+
+    def closure(self, pkgname):
+        """ :param pkgname: The name of the package.
+        :return: List of names of the package and the packages that the package transitively requires to build.
+        Empty if no plan resolves the package.
+        """
+        if pkgname in self.closures:
+            return self.closures[pkgname]
+        if pkgname not in self.pkgname_to_plan:
+            # The package may be resolved by a plan later, so this is not memoized.
+            return []
+        # Requisites of a plan are already closed, since they have been resolved by this index.
+        closure = dedup([pkgname] + self.pkgname_to_plan[pkgname].requisites)
+        self.closures[pkgname] = closure
+        return closure
+
+
 def convert_graph_to_plans(graph, repository):
     """ :param graph: List of DependencyEdges from the root vertex of the package dependency graph.
     :param repository: The current repository.
@@ -81,70 +116,134 @@ def convert_graph_to_plans(graph, repository):
     # Root buildable with 'light' dependencies comes first.
     root_edges = [edge for edge in graph if edge.vertex_to is not None]
     root_edges.sort(key=lambda edge: edge.vertex_to.num_build_time_dependencies)
+    cycles = find_cycles([edge.vertex_to for edge in root_edges])
+    if len(cycles) > 0:
+        for cycle in cycles:
+            log(LogLevel.error, 'Cyclic dependency: {}', '→'.join(cycle))
+        raise CyclicDependencyError(cycles)
     source_to_plan = dict()
-    lists_of_plans = [do_visit_vertex(edge.vertex_to, repository, [], source_to_plan) for edge in root_edges]
+    index = PlanIndex()
+    lists_of_plans = [do_visit_vertex(edge.vertex_to, repository, source_to_plan, index) for edge in root_edges]
     return dedup([plan for plans in lists_of_plans for plan in plans])
 
 
-def do_visit_vertex(vertex, repository, required_by, source_to_plan):
-    """ :param vertex: The DependencyVertex.
+def do_visit_vertex(vertex, repository, source_to_plan, index):
+    """ Visits an acyclic subgraph in depth-first post-order, without recursion.
+    :param vertex: The DependencyVertex.
     :param repository: The Repository.
-    :param required_by: List of names of packages that requires building this package for building and checking.
     :param source_to_plan: Dictionary with each entry from source reference to Plan. Treated as a mutable object.
+    :param index: PlanIndex of the plans created so far. Treated as a mutable object.
     :return: List of Plans to build packages specified by this subtree.
     """
-    pkgname = vertex.buildable.package_info.pkgname
-    if pkgname in required_by:
-        raise CyclicDependencyError(vertex.buildable.package_info.pkgname)
-    plans = list()
-    for edge in vertex.edges:
-        if not edge.is_resolved:
-            raise Exception('Edge {} is not resolved'.format(edge))
-        if edge.vertex_to is None:
-            continue
-        sub_vertex = edge.vertex_to
-        if sub_vertex.buildable.source_reference in source_to_plan:
-            # Merge into existing Plan.
-            existing_plan = source_to_plan[sub_vertex.buildable.source_reference]
-            existing_plan.add(edge.pkgname, repository)
-            plans.append(existing_plan)
+    # Each frame holds a vertex being visited, the iterator over its remaining edges, and the Plans collected so far.
+    frames = [(vertex, iter(vertex.edges), list())]
+    while True:
+        vertex, edges, plans = frames[-1]
+        for edge in edges:
+            if not edge.is_resolved:
+                raise Exception('Edge {} is not resolved'.format(edge))
+            if edge.vertex_to is None:
+                continue
+            sub_vertex = edge.vertex_to
+            if sub_vertex.buildable.source_reference in source_to_plan:
+                # Merge into existing Plan.
+                existing_plan = source_to_plan[sub_vertex.buildable.source_reference]
+                existing_plan.add(edge.pkgname, repository)
+                index.add(edge.pkgname, existing_plan)
+                plans.append(existing_plan)
+                continue
+            frames.append((sub_vertex, iter(sub_vertex.edges), list()))
+            break
+        else:
+            frames.pop()
+            plans = dedup(plans)
+            pkgname = vertex.buildable.package_info.pkgname
+            source = vertex.buildable.source_reference
+            # Visiting another package from the same source in the subtree may have created Plan for this package.
+            # So we double-check the existence.
+            if source not in source_to_plan:
+                source_to_plan[source] = Plan.from_buildable(vertex.buildable, index)
+                plans.append(source_to_plan[source])
+            source_to_plan[source].add(pkgname, repository)
+            index.add(pkgname, source_to_plan[source])
+            if len(frames) == 0:
+                return plans
+            frames[-1][2].extend(plans)
+
+
+def find_cycles(vertices):
+    """ Finds strongly connected components with cycles by Tarjan's algorithm, without recursion.
+    :param vertices: List of DependencyVertices to start from.
+    :return: List of cycles, one for each strongly connected component with a cycle. Each cycle is the list of names
+    of packages in the order of dependency, ending with the first one.
+    """
+    def successors(vertex):
+        return [edge.vertex_to for edge in vertex.edges if edge.vertex_to is not None]
+
+    vertex_to_index = dict()
+    vertex_to_lowlink = dict()
+    stack = list()
+    on_stack = set()
+    cycles = list()
+    for root in vertices:
+        if root in vertex_to_index:
             continue
-        try:
-            plans.extend(do_visit_vertex(sub_vertex, repository, required_by + [pkgname], source_to_plan))
-        except CyclicDependencyError as e:
-            e.chain(pkgname)
-            raise e
-    plans = dedup(plans)
-    source = vertex.buildable.source_reference
-    # Recursive incarnation of 'do_visit_vertex' may have created Plan for this package
-    # while resolving cyclic dependency due to runtime dependencies.
-    # So we double-check the existence.
-    if source not in source_to_plan:
-        source_to_plan[source] = Plan.from_buildable(vertex.buildable, plans)
-        plans.append(source_to_plan[source])
-    source_to_plan[source].add(pkgname, repository)
-    return plans
+        vertex_to_index[root] = vertex_to_lowlink[root] = len(vertex_to_index)
+        stack.append(root)
+        on_stack.add(root)
+        frames = [(root, iter(successors(root)))]
+        while len(frames) > 0:
+            vertex, vertices_to = frames[-1]
+            for vertex_to in vertices_to:
+                if vertex_to not in vertex_to_index:
+                    vertex_to_index[vertex_to] = vertex_to_lowlink[vertex_to] = len(vertex_to_index)
+                    stack.append(vertex_to)
+                    on_stack.add(vertex_to)
+                    frames.append((vertex_to, iter(successors(vertex_to))))
+                    break
+                elif vertex_to in on_stack:
+                    vertex_to_lowlink[vertex] = min(vertex_to_lowlink[vertex], vertex_to_index[vertex_to])
+            else:
+                frames.pop()
+                if len(frames) > 0:
+                    parent = frames[-1][0]
+                    vertex_to_lowlink[parent] = min(vertex_to_lowlink[parent], vertex_to_lowlink[vertex])
+                if vertex_to_lowlink[vertex] != vertex_to_index[vertex]:
+                    continue
+                component = set()
+                while vertex not in component:
+                    component.add(stack.pop())
+                on_stack.difference_update(component)
+                if len(component) > 1 or vertex in successors(vertex):
+                    cycles.append(cycle_in_component(vertex, component, successors))
+    return cycles
+
+
+def cycle_in_component(vertex, component, successors):
+    """ :param vertex: A DependencyVertex in the strongly connected component.
+    :param component: Set of DependencyVertices in the strongly connected component.
+    :param successors: Function from a DependencyVertex to the list of DependencyVertices it depends on.
+    :return: List of names of packages in a cycle from the vertex, ending with the first one in the cycle.
+    """
+    path = list()
+    vertex_to_position = dict()
+    while vertex not in vertex_to_position:
+        vertex_to_position[vertex] = len(path)
+        path.append(vertex)
+        vertex = next(vertex_to for vertex_to in successors(vertex) if vertex_to in component)
+    cycle = path[vertex_to_position[vertex]:] + [vertex]
+    return [vertex.buildable.package_info.pkgname for vertex in cycle]
 
 
 class CyclicDependencyError(Exception):
     """ Cyclic build-time dependency error. """
 
-    def __init__(self, pkgname):
-        """ :param pkgname: The name of the package of which this error is triggered. """
-        self.chain = [pkgname]
-        self.terminal = pkgname
-        self.closed = False
-
-    def chain(self, pkgname):
-        """ :param pkgname: The name of the package to add to the chain. """
-        if self.closed:
-            return
-        self.chain.insert(0, pkgname)
-        if pkgname == self.terminal:
-            self.closed = True
+    def __init__(self, cycles):
+        """ :param cycles: List of cycles, each of which is the list of names of packages in the cycle. """
+        self.cycles = cycles
 
     def __str__(self):
-        return '→'.join(self.chain)
+        return ', '.join('→'.join(cycle) for cycle in self.cycles)
 
     def __repr__(self):
-        return '\'{}\''.format('->'.join(self.chain))
+        return '\'{}\''.format(', '.join('->'.join(cycle) for cycle in self.cycles))
@@ -0,0 +1,191 @@
+#!/usr/bin/python3
+
+from collections import OrderedDict
+from hashlib import md5
+from hashlib import sha256
+from io import BytesIO
+from os import symlink
+from os.path import getsize
+from os.path import lexists
+from os.path import basename
+from tarfile import open as tarfile_open
+from tarfile import TarInfo
+from tarfile import DIRTYPE
+from tarfile import CompressionError
+from tarfile import ReadError
+from time import time
+from .utils import run
+from .utils import atomic_file
+
+
+# Fields of 'desc' in the order written by repo-add, with the corresponding keys in .PKGINFO.
+DESC_FIELDS = [('FILENAME', None), ('NAME', 'pkgname'), ('BASE', 'pkgbase'), ('VERSION', 'pkgver'),
+               ('DESC', 'pkgdesc'), ('GROUPS', 'group'), ('CSIZE', None), ('ISIZE', 'size'), ('MD5SUM', None),
+               ('SHA256SUM', None), ('URL', 'url'), ('LICENSE', 'license'), ('ARCH', 'arch'),
+               ('BUILDDATE', 'builddate'), ('PACKAGER', 'packager'), ('REPLACES', 'replaces'),
+               ('CONFLICTS', 'conflict'), ('PROVIDES', 'provides'), ('DEPENDS', 'depend'),
+               ('OPTDEPENDS', 'optdepend'), ('MAKEDEPENDS', 'makedepend'), ('CHECKDEPENDS', 'checkdepend')]
+
+
+class RepoDBEntry:
+    """ An entry of a repository database, i.e. a directory with 'desc' (and 'files' in the files database). """
+
+    def __init__(self, directory_name, desc, files=None):
+        """ :param directory_name: The name of the directory, which is '<pkgname>-<version>'.
+        :param desc: Content of 'desc'.
+        :param files: Content of 'files'. None if not loaded.
+        """
+        self.directory_name = directory_name
+        self.desc = desc
+        self.files = files
+        self.fields = parse_desc(desc)
+
+    @property
+    def name(self):
+        """ :return: The pkgname. """
+        return self.fields['NAME'][0]
+
+    @property
+    def version(self):
+        """ :return: The version string. """
+        return self.fields['VERSION'][0]
+
+    @property
+    def filename(self):
+        """ :return: The name of the package file. """
+        return self.fields['FILENAME'][0]
+
+    def __str__(self):
+        return self.directory_name
+
+    def __repr__(self):
+        return 'RepoDBEntry({})'.format(repr(self.directory_name))
+
+
+def parse_desc(desc):
+    """ :param desc: Content of 'desc' or 'files'.
+    :return: Dictionary from the name of each field to the list of its values.
+    """
+    fields = dict()
+    values = None
+    for line in desc.decode().splitlines():
+        if line.startswith('%') and line.endswith('%') and len(line) > 2:
+            values = fields.setdefault(line[1:-1], list())
+        elif len(line) > 0 and values is not None:
+            values.append(line)
+    return fields
+
+
+def format_desc(fields):
+    """ :param fields: List of pairs of the name of each field and the list of its values.
+    :return: Content of 'desc', formatted as by repo-add. Fields without values are omitted.
+    """
+    return ''.join('%{}%\n{}\n'.format(field, ''.join(value + '\n' for value in values))
+                   for field, values in fields if len(values) > 0 and len(values[0]) > 0).encode()
+
+
+def read_repodb(path, member_names=('desc',)):
+    """ Reads a repository database as a stream.
+    :param path: Path to the database.
+    :param member_names: The names of the files to read in each directory.
+    :return: OrderedDict from the directory name to the dictionary from the file name to its content.
+    """
+    directories = OrderedDict()
+    with tarfile_open(path, mode='r|*') as tar:
+        for member in tar:
+            directory_name, _, member_name = member.name.rstrip('/').partition('/')
+            if member.isdir():
+                directories.setdefault(directory_name, dict())
+            elif member_name in member_names:
+                directories.setdefault(directory_name, dict())[member_name] = tar.extractfile(member).read()
+    return directories
+
+
+def read_entries(path, with_files=False):
+    """ :param path: Path to the database.
+    :param with_files: Whether to read 'files' as well. Only for the files database.
+    :return: OrderedDict from pkgname to RepoDBEntry.
+    """
+    entries = OrderedDict()
+    for directory_name, members in read_repodb(path, ('desc', 'files') if with_files else ('desc',)).items():
+        if 'desc' not in members:
+            continue
+        entry = RepoDBEntry(directory_name, members['desc'], members.get('files'))
+        entries[entry.name] = entry
+    return entries
+
+
+def write_repodb(path, entries, with_files=False):
+    """ Atomically writes a gzip-compressed repository database, and the symbolic link without '.tar.gz'.
+    :param path: Path to the database.
+    :param entries: Iterable of RepoDBEntries.
+    :param with_files: Whether to write 'files' as well. Only for the files database.
+    """
+    mtime = int(time())
+    with atomic_file(path, mode='wb') as file, tarfile_open(path, mode='w:gz', fileobj=file) as tar:
+        for entry in entries:
+            directory = TarInfo(entry.directory_name)
+            directory.type = DIRTYPE
+            directory.mode = 0o755
+            directory.mtime = mtime
+            tar.addfile(directory)
+            members = [('desc', entry.desc)] + ([('files', entry.files)] if with_files else [])
+            for member_name, content in members:
+                info = TarInfo('{}/{}'.format(entry.directory_name, member_name))
+                info.size = len(content)
+                info.mode = 0o644
+                info.mtime = mtime
+                tar.addfile(info, BytesIO(content))
+    link_path = path[:-len('.tar.gz')]
+    if not lexists(link_path):
+        symlink(basename(path), link_path)
+
+
+def package_entry(package_file_path):
+    """ Builds the database entry of a package file, as repo-add does.
+    :param package_file_path: The path to the package file.
+    :return: RepoDBEntry with 'files'.
+    """
+    pkginfo, paths = read_package(package_file_path)
+    pkginfo_fields = dict()
+    for line in pkginfo.decode().splitlines():
+        if line.startswith('#') or ' = ' not in line:
+            continue
+        key, _, value = line.partition(' = ')
+        pkginfo_fields.setdefault(key, list()).append(value)
+    md5_hash = md5()
+    sha256_hash = sha256()
+    with open(package_file_path, mode='rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            md5_hash.update(block)
+            sha256_hash.update(block)
+    computed = {'FILENAME': [basename(package_file_path)], 'CSIZE': [str(getsize(package_file_path))],
+                'MD5SUM': [md5_hash.hexdigest()], 'SHA256SUM': [sha256_hash.hexdigest()]}
+    fields = [(field, computed[field] if key is None else pkginfo_fields.get(key, list()))
+              for field, key in DESC_FIELDS]
+    directory_name = '{}-{}'.format(pkginfo_fields['pkgname'][0], pkginfo_fields['pkgver'][0])
+    files = ''.join(['%FILES%\n'] + [path + '\n' for path in sorted(set(paths))]).encode()
+    return RepoDBEntry(directory_name, format_desc(fields), files)
+
+
+def read_package(package_file_path):
+    """ :param package_file_path: The path to the package file.
+    :return: Tuple of the content of .PKGINFO and the list of paths in the package, except for metadata files.
+    """
+    try:
+        pkginfo = None
+        paths = list()
+        with tarfile_open(package_file_path, mode='r|*') as tar:
+            for member in tar:
+                if member.name == '.PKGINFO':
+                    pkginfo = tar.extractfile(member).read()
+                elif not member.name.startswith('.'):
+                    paths.append(member.name + '/' if member.isdir() else member.name)
+        return pkginfo, paths
+    except (CompressionError, ReadError):
+        # Compression not supported by tarfile (e.g. zstd).
+        pkginfo = run(['bsdtar', '-xOf', package_file_path, '.PKGINFO'], quiet=True).encode()
+        paths = [path for path in run(['bsdtar', '-tf', package_file_path], quiet=True).splitlines()
+                 if not path.startswith('.')]
+        return pkginfo, paths
+
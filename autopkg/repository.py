@@ -1,36 +1,62 @@
 #!/usr/bin/python3
 
+from contextlib import contextmanager
 from os.path import join
 from os.path import exists
 from os.path import basename
-from tarfile import open as tarfile_open
+from os.path import lexists
+from os.path import getsize
+from os import listdir
+from os import symlink
+from os import link
+from os import remove
 from .utils import run
+from .utils import lock_file
+from .repodb import read_entries
+from .repodb import write_repodb
+from .repodb import package_entry
 from .package import PackageTinyInfo
-from .package import pick_package_file
+from .package import PackageFile
+from .trace import span
 
 
 class Repository:
     """ An Arch repository. """
 
-    def __init__(self, name, path, sign_key=None, sudo=False):
+    def __init__(self, name, path, sign_key=None, sudo=False, lock_name=None):
         """ :param name: The name of this repository.
         :param path: Path to this repository.
         :param sign_key: GPG key to sign. None means no signing.
         :param sudo: Whether to modify this repository using sudo(1) or not.
+        :param lock_name: The name of the lock file that guards this repository against other runs of autopkg. None
+        means no locking, for repositories private to this run.
         """
         self.name = name
         self.directory = path
         self.sign_key = sign_key
         self.sign_parameters = ['-s', '-k', sign_key] if sign_key else []
         self.sudo = sudo
+        self.lock_name = lock_name
+        self.staged = None
 
         self.db_path = join(path, name + '.db.tar.gz')
+        self.files_db_path = join(path, name + '.files.tar.gz')
         if not exists(self.db_path):
-            run(['repo-add', self.db_path], sudo=sudo, capture=False)
+            with self.locked():
+                if not exists(self.db_path):
+                    if sudo:
+                        run(['repo-add', self.db_path], sudo=sudo, capture=False)
+                    else:
+                        self.write_databases(list(), list())
 
-        packages = [PackageTinyInfo.from_repodb_directory_name(member.name) for member
-                    in tarfile_open(self.db_path).getmembers() if member.isdir()]
-        self.packages = {package.name: package for package in packages}
+        with self.locked(shared=True):
+            self.entries = read_entries(self.db_path)
+            file_names = set(listdir(path))
+        self.packages = {pkgname: PackageTinyInfo(pkgname, entry.version) for pkgname, entry in self.entries.items()}
+        self.package_files = {pkgname: PackageFile(join(path, entry.filename), entry.filename + '.sig' in file_names,
+                                                   int(entry.fields['CSIZE'][0]) if 'CSIZE' in entry.fields else None)
+                              for pkgname, entry in self.entries.items()}
+        self.computed_entries = dict()
 
     def __str__(self):
         return 'Repository {} at {} (key={}, sudo={})'.format(self.name, self.directory, self.sign_key, self.sudo)
@@ -39,6 +65,45 @@ class Repository:
         return 'Repository({}, {}, sign_key={}, sudo={})'.format(repr(self.name), repr(self.directory),
                                                                  repr(self.sign_key), repr(self.sudo))
 
+    @contextmanager
+    def locked(self, shared=False):
+        """ :param shared: Whether to only read the repository, allowing other readers at the same time.
+        :return: Context manager in which no other run of autopkg changes the repository database and the package
+        files. Exclusive locks are taken only around changes, so that readers are not blocked by long builds.
+        """
+        if self.lock_name is None:
+            yield
+            return
+        with lock_file(self.lock_name, shared=shared, description='the database of repository {}'.format(self.name)):
+            yield
+
+    @contextmanager
+    def transaction(self):
+        """ :return: Context manager in which added packages are staged, and then registered to the repository
+        database at once on exit.
+        """
+        if self.staged is not None:
+            yield
+            return
+        self.staged = dict()
+        try:
+            yield
+        finally:
+            self.commit()
+            self.staged = None
+
+    def commit(self):
+        """ Registers the staged packages to the repository database. """
+        if not self.staged:
+            return
+        with span('commit', profile=True, repository=self.name, packages=len(self.staged)), self.locked():
+            if self.sudo:
+                run(['repo-add', '-R'] + self.sign_parameters + [self.db_path] + list(self.staged.values()),
+                    sudo=self.sudo, capture=False)
+            else:
+                self.update_databases(list(self.staged.values()), list())
+        self.staged = dict()
+
     def add(self, package_file_path):
         """ Adds a package to the repository.
         :param package_file_path: The path to the package file.
@@ -51,21 +116,128 @@ class Repository:
         if self.sign_key:
             run(['gpg', '--detach-sign', '--no-armor', '--default-key', self.sign_key, repository_package_path],
                 sudo=self.sudo, capture=False)
-        run(['repo-add', '-R'] + self.sign_parameters + [self.db_path, repository_package_path],
-            sudo=self.sudo, capture=False)
+        if self.staged is not None:
+            if package.name in self.staged and self.staged[package.name] != repository_package_path:
+                # Superseded within the transaction. Never registered, so just drop it.
+                run(['rm', '-f', self.staged[package.name], self.staged[package.name] + '.sig'], sudo=self.sudo)
+            self.staged[package.name] = repository_package_path
+        elif self.sudo:
+            with self.locked():
+                run(['repo-add', '-R'] + self.sign_parameters + [self.db_path, repository_package_path],
+                    sudo=self.sudo, capture=False)
+        else:
+            with self.locked():
+                self.update_databases([repository_package_path], list())
         self.packages[package.name] = package
+        self.package_files[package.name] = PackageFile(repository_package_path, self.sign_key is not None,
+                                                       getsize(package_file_path))
 
-    def find_package_file_path(self, pkgname):
-        """ :param pkgname: The name of the package to find. """
+    def find_package_file(self, pkgname):
+        """ :param pkgname: The name of the package to find.
+        :return: The PackageFile of the package.
+        """
         if pkgname not in self.packages:
             raise Exception('Package {} not in {}'.format(pkgname, self))
-        file_name = pick_package_file(pkgname, self.directory)
-        return join(self.directory, file_name)
+        return self.package_files[pkgname]
+
+    def find_package_file_path(self, pkgname):
+        """ :param pkgname: The name of the package to find. """
+        return self.find_package_file(pkgname).path
 
     def remove(self, pkgname):
         """ :param pkgname: The name of the package to remove. """
-        file_path = self.find_package_file_path(pkgname)
-        run(['rm', '-f', file_path], sudo=self.sudo)
-        run(['rm', '-f', file_path + '.sig'], sudo=self.sudo)
-        run(['repo-remove'] + self.sign_parameters + [self.db_path, pkgname], sudo=self.sudo, capture=False)
+        self.commit()
+        package_file = self.find_package_file(pkgname)
+        with self.locked():
+            run(['rm', '-f', package_file.path], sudo=self.sudo)
+            if package_file.signature_path is not None:
+                run(['rm', '-f', package_file.signature_path], sudo=self.sudo)
+            if self.sudo:
+                run(['repo-remove'] + self.sign_parameters + [self.db_path, pkgname], sudo=self.sudo, capture=False)
+            else:
+                self.update_databases(list(), [pkgname])
         del self.packages[pkgname]
+        del self.package_files[pkgname]
+
+    def link(self, repository, pkgnames):
+        """ Makes packages of another repository available in this repository without copying, by hard links (or
+        reflinks, or copies as a fallback, across file systems). The repository database is written once from the
+        entries the other repository already has, and only if anything has changed. The files database is left as is.
+        :param repository: The repository that has the packages.
+        :param pkgnames: The names of the packages.
+        """
+        if self.sudo or self.sign_key:
+            raise Exception('Cannot link packages into {}'.format(self))
+        changed = False
+        for pkgname in pkgnames:
+            package = repository.packages[pkgname]
+            if pkgname in self.packages and self.packages[pkgname].version == package.version:
+                continue
+            source_package_file = repository.package_files[pkgname]
+            repository_package_path = join(self.directory, basename(source_package_file.path))
+            if pkgname in self.package_files:
+                old_package_file = self.package_files[pkgname]
+                remove(old_package_file.path)
+                if old_package_file.signature_path is not None:
+                    remove(old_package_file.signature_path)
+            try:
+                link(source_package_file.path, repository_package_path)
+            except OSError:
+                run(['cp', '--reflink=auto', source_package_file.path, repository_package_path])
+            self.entries[pkgname] = repository.entry(pkgname)
+            self.packages[pkgname] = package
+            self.package_files[pkgname] = PackageFile(repository_package_path, False, source_package_file.size)
+            changed = True
+        if changed:
+            write_repodb(self.db_path, self.entries.values())
+
+    def entry(self, pkgname):
+        """ :param pkgname: The name of the package.
+        :return: RepoDBEntry of the package, including staged ones.
+        """
+        package_file_path = self.find_package_file_path(pkgname)
+        entry = self.entries.get(pkgname)
+        if entry is not None and entry.filename == basename(package_file_path):
+            return entry
+        return self.package_entry(package_file_path)
+
+    def package_entry(self, package_file_path):
+        """ :param package_file_path: The path to the package file in the repository directory.
+        :return: RepoDBEntry of the package file, computed at most once.
+        """
+        if package_file_path not in self.computed_entries:
+            self.computed_entries[package_file_path] = package_entry(package_file_path)
+        return self.computed_entries[package_file_path]
+
+    def update_databases(self, package_file_paths, pkgnames_to_remove):
+        """ Updates the repository database and the files database in-process, like 'repo-add -R' and 'repo-remove'.
+        :param package_file_paths: The paths to the package files to add, in the repository directory.
+        :param pkgnames_to_remove: The names of the packages to remove.
+        """
+        files_entries = read_entries(self.files_db_path, with_files=True) if exists(self.files_db_path) else dict()
+        for pkgname in pkgnames_to_remove:
+            self.entries.pop(pkgname, None)
+            files_entries.pop(pkgname, None)
+        for package_file_path in package_file_paths:
+            entry = self.package_entry(package_file_path)
+            old_entry = self.entries.get(entry.name)
+            if old_entry is not None and old_entry.filename != entry.filename:
+                old_package_file_path = join(self.directory, old_entry.filename)
+                run(['rm', '-f', old_package_file_path, old_package_file_path + '.sig'], sudo=self.sudo)
+            self.entries[entry.name] = entry
+            files_entries[entry.name] = entry
+        self.write_databases(self.entries.values(), files_entries.values())
+
+    def write_databases(self, entries, files_entries):
+        """ :param entries: RepoDBEntries for the repository database.
+        :param files_entries: RepoDBEntries with 'files' for the files database.
+        """
+        write_repodb(self.db_path, entries)
+        write_repodb(self.files_db_path, files_entries, with_files=True)
+        if self.sign_key:
+            for path in [self.db_path, self.files_db_path]:
+                run(['gpg', '--detach-sign', '--no-armor', '--yes', '--default-key', self.sign_key, path],
+                    capture=False)
+                link_path = path[:-len('.tar.gz')] + '.sig'
+                if not lexists(link_path):
+                    symlink(basename(path) + '.sig', link_path)
@@ -0,0 +1,87 @@
+#!/usr/bin/python3
+
+from json import dumps
+from json import loads
+from json.decoder import JSONDecodeError
+from os.path import join
+from time import localtime
+from time import strftime
+from time import time
+from .utils import mkdir
+from .utils import atomic_file
+from .utils import log
+from .utils import LogLevel
+from .utils import plan_home
+from .utils import repository_name
+from .backends import recorded_token
+from .backends import current_tokens
+from .plan import Plan
+from .trace import span
+
+
+# Bumped whenever the format of snapshots changes, so that older snapshots are recomputed instead of misread.
+SNAPSHOT_VERSION = 1
+
+
+def snapshot_path():
+    """ :return: Path to the plan snapshot of the repository. """
+    return join(mkdir(plan_home), repository_name + '.json')
+
+
+def repository_versions(repository):
+    """ :param repository: The Repository.
+    :return: Dictionary from the name of each package in the repository to its version string.
+    """
+    return {pkgname: str(package.version) for pkgname, package in repository.packages.items()}
+
+
+def save_snapshot(plans, targets, git_sources, repository):
+    """ Atomically writes plans with everything they have been computed from.
+    :param plans: List of Plans.
+    :param targets: The target pkgnames the plans have been computed for.
+    :param git_sources: The git sources the plans have been computed with.
+    :param repository: The Repository the plans have been computed against.
+    """
+    snapshot = {'version': SNAPSHOT_VERSION,
+                'time': time(),
+                'targets': targets,
+                'git': git_sources,
+                'repository': repository_versions(repository),
+                'tokens': [recorded_token(plan.buildable) for plan in plans],
+                'plans': [plan.to_json() for plan in plans]}
+    with atomic_file(snapshot_path()) as file:
+        file.write(dumps(snapshot, separators=(',', ':')))
+
+
+def load_snapshot(targets, git_sources, repository):
+    """ Reads the saved plans, if they are still what planning would compute now. Nothing is re-resolved: the plans
+    are checked against the configuration, the repository and the freshness tokens of their sources.
+    :param targets: The current target pkgnames.
+    :param git_sources: The current git sources.
+    :param repository: The Repository.
+    :return: List of Plans. None if there is no valid snapshot.
+    """
+    try:
+        with open(snapshot_path()) as file:
+            snapshot = loads(file.read())
+    except (FileNotFoundError, JSONDecodeError):
+        log(LogLevel.info, 'No saved plan.')
+        return None
+    if snapshot.get('version') != SNAPSHOT_VERSION:
+        log(LogLevel.info, 'The saved plan is from another version.')
+        return None
+    if snapshot['targets'] != targets or snapshot['git'] != git_sources:
+        log(LogLevel.info, 'The configuration has changed since the saved plan.')
+        return None
+    if snapshot['repository'] != repository_versions(repository):
+        log(LogLevel.info, 'The repository has changed since the saved plan.')
+        return None
+    plans = [Plan.from_json(json) for json in snapshot['plans']]
+    with span('check snapshot', profile=True, plans=len(plans)):
+        tokens = current_tokens([plan.buildable for plan in plans])
+    for plan, token, saved_token in zip(plans, tokens, snapshot['tokens']):
+        if saved_token is None or token != saved_token:
+            log(LogLevel.info, '{} has changed since the saved plan.', plan.buildable.source_reference)
+            return None
+    log(LogLevel.good, 'Using the plan saved at {}.', strftime('%Y-%m-%d %H:%M:%S', localtime(snapshot['time'])))
+    return plans
@@ -0,0 +1,150 @@
+#!/usr/bin/python3
+
+from contextlib import contextmanager
+from cProfile import Profile
+from json import dump
+from os import getpid
+from os import listdir
+from os import remove
+from os import replace
+from os.path import getmtime
+from os.path import join
+from os.path import split
+from re import escape
+from re import match
+from tempfile import mkstemp
+from threading import Lock
+from threading import current_thread
+from threading import get_ident
+from threading import main_thread
+from time import perf_counter
+from time import strftime
+
+
+# The number of traces to keep for each repository.
+TRACE_HISTORY = 32
+
+
+class Tracer:
+    """ Records timed spans as events of the Chrome trace format. """
+
+    def __init__(self, profile=None):
+        """ :param profile: cProfile.Profile to enable within profiled spans. None means no profiling. """
+        self.events = list()
+        self.lock = Lock()
+        self.origin = perf_counter()
+        self.profile = profile
+        self.profile_depth = 0
+
+    def add(self, name, category, start, end, args):
+        """ :param name: The name of the span.
+        :param category: The category of the span.
+        :param start: perf_counter() at the start.
+        :param end: perf_counter() at the end.
+        :param args: Dictionary of arguments to show with the span.
+        """
+        event = {'name': name, 'cat': category, 'ph': 'X', 'pid': getpid(), 'tid': get_ident(),
+                 'ts': round((start - self.origin) * 1e6), 'dur': round((end - start) * 1e6), 'args': args}
+        with self.lock:
+            self.events.append(event)
+
+    def write(self, path):
+        """ Atomically writes the recorded spans, through a uniquely named temporary file.
+        :param path: Path to the trace file, which can be loaded in chrome://tracing or Perfetto.
+        """
+        with self.lock:
+            events = list(self.events)
+        directory, name = split(path)
+        descriptor, temporary_path = mkstemp(prefix='.{}.'.format(name), suffix='.tmp', dir=directory)
+        try:
+            with open(descriptor, mode='wt') as file:
+                dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, file)
+            replace(temporary_path, path)
+        except BaseException:
+            remove(temporary_path)
+            raise
+
+    @contextmanager
+    def profiling(self):
+        """ :return: Context manager in which the Python-side execution of the main thread is profiled. """
+        if self.profile is None or current_thread() is not main_thread():
+            yield
+            return
+        if self.profile_depth == 0:
+            self.profile.enable()
+        self.profile_depth += 1
+        try:
+            yield
+        finally:
+            self.profile_depth -= 1
+            if self.profile_depth == 0:
+                self.profile.disable()
+
+
+@contextmanager
+def tracing(trace_path, profile_path=None):
+    """ :param trace_path: Path to write the timeline of spans to, on exit. None means neither tracing nor profiling.
+    :param profile_path: Path to dump cProfile stats of profiled spans to, on exit. None means no profiling.
+    :return: Context manager in which spans are recorded.
+    """
+    if trace_path is None:
+        yield None
+        return
+    tracer = Tracer(Profile() if profile_path is not None else None)
+    tracing.tracer = tracer
+    try:
+        yield tracer
+    finally:
+        tracing.tracer = None
+        tracer.write(trace_path)
+        if tracer.profile is not None:
+            tracer.profile.dump_stats(profile_path)
+
+
+tracing.tracer = None
+
+
+def trace_file_name(name):
+    """ :param name: The name of the repository.
+    :return: The name of the trace file for this run, by the time and the process, so that each run keeps its own.
+    """
+    return '{}-{}-{}.json'.format(name, strftime('%Y%m%d-%H%M%S'), getpid())
+
+
+def evict_traces(directory, name, capacity):
+    """ Removes the oldest traces of a repository.
+    :param directory: The directory of trace files.
+    :param name: The name of the repository.
+    :param capacity: The number of traces to keep.
+    """
+    pattern = '^{}-[0-9]{{8}}-[0-9]{{6}}-[0-9]+\\.json$'.format(escape(name))
+    paths = [join(directory, file_name) for file_name in listdir(directory) if match(pattern, file_name)]
+    paths.sort(key=getmtime, reverse=True)
+    for path in paths[capacity:]:
+        try:
+            remove(path)
+        except FileNotFoundError:
+            pass
+
+
+@contextmanager
+def span(name, category='phase', profile=False, **args):
+    """ :param name: The name of the span.
+    :param category: The category of the span.
+    :param profile: Whether to profile the span when AUTOPKG_PROFILE is set.
+    :param args: Arguments to show with the span.
+    :return: Context manager for a timed span. Nothing is recorded outside of 'tracing'.
+    """
+    tracer = tracing.tracer
+    if tracer is None:
+        yield
+        return
+    start = perf_counter()
+    try:
+        if profile:
+            with tracer.profiling():
+                yield
+        else:
+            yield
+    finally:
+        tracer.add(name, category, start, perf_counter(), args)
@@ -2,10 +2,17 @@
 
 from contextlib import contextmanager
 from urllib.request import urlopen
+from urllib.request import Request
+from urllib.error import HTTPError
 from tempfile import TemporaryDirectory
+from tempfile import mkstemp
 from os import environ
 from os.path import join
+from os.path import split
 from os import remove
+from os import replace
+from os import fchmod
+from os import umask
 from pathlib import Path
 from subprocess import run as subprocess_run
 from subprocess import PIPE
@@ -16,10 +23,20 @@ from json.decoder import JSONDecodeError
 from enum import Enum
 from fcntl import flock
 from fcntl import LOCK_EX
+from fcntl import LOCK_SH
+from fcntl import LOCK_NB
 from fcntl import LOCK_UN
-from re import sub
+from re import compile as re_compile
 from time import strftime
+from time import localtime
+from time import time
+from time import sleep
 from sys import stderr
+from threading import Lock
+from threading import Thread
+from threading import Event
+from atexit import register as atexit_register
+from .trace import span
 
 
 home = str(Path.home())
@@ -31,8 +48,28 @@ run_lock_home = join(autopkg_home, 'run_lock')
 log_home = join(autopkg_home, 'log')
 repository_home = join(autopkg_home, 'repository')
 autoremovable_home = join(autopkg_home, 'autoremovable')
+cache_home = join(autopkg_home, 'cache')
+mirror_home = join(autopkg_home, 'mirror')
+chroot_home = join(autopkg_home, 'chroot')
+trace_home = join(autopkg_home, 'trace')
+plan_home = join(autopkg_home, 'plan')
 sign_key = environ.get('AUTOPKG_KEY', None)
 num_retrials = int(environ.get('AUTOPKG_RETRY', 3))
+num_jobs = max(1, int(environ.get('AUTOPKG_JOBS', 1)))
+chroot_refresh_interval = int(environ.get('AUTOPKG_CHROOT_REFRESH', 86400))
+metadata_ttl = int(environ.get('AUTOPKG_CACHE_TTL', 300))
+aur_mirror_capacity = int(environ.get('AUTOPKG_AUR_MIRROR_CAPACITY', 256))
+build_cache_capacity = int(environ.get('AUTOPKG_BUILD_CACHE_SIZE', 4096)) * 2 ** 20
+log_file_level = environ.get('AUTOPKG_LOG_LEVEL', 'debug')
+log_format = environ.get('AUTOPKG_LOG_FORMAT', 'text')
+log_flush_interval = float(environ.get('AUTOPKG_LOG_FLUSH_INTERVAL', 1))
+profile_path = environ.get('AUTOPKG_PROFILE', None)
+lock_timeout = float(environ.get('AUTOPKG_LOCK_TIMEOUT', 600))
+# Seconds between attempts to get a contended lock.
+LOCK_POLL_INTERVAL = 0.5
+# The file mode creation mask. It can only be read by setting it, so it is read once at startup.
+file_mode_mask = umask(0o022)
+umask(file_mode_mask)
 
 
 def run(command, sudo=False, cwd=None, capture=True, quiet=False, stdin=None, allow_error=False):
@@ -52,7 +89,9 @@ def run(command, sudo=False, cwd=None, capture=True, quiet=False, stdin=None, al
         log(LogLevel.fine, ' '.join(cmd))
     file = PIPE if capture else None
     try:
-        completed = subprocess_run(cmd, cwd=cwd, stdout=file, stderr=file, check=True, encoding='utf-8', input=stdin)
+        with span(command[0], category='run', command=' '.join(cmd), cwd=cwd):
+            completed = subprocess_run(cmd, cwd=cwd, stdout=file, stderr=file, check=True, encoding='utf-8',
+                                       input=stdin)
         if capture:
             return completed.stdout
         else:
@@ -68,15 +107,34 @@ def run(command, sudo=False, cwd=None, capture=True, quiet=False, stdin=None, al
         raise e
 
 
-def url_read(url_format, *args):
-    """ :param url_format: Format string for the URL of the resource.
-    :param args: Format arguments.
-    :return: Fetched response.
+@contextmanager
+def url_open_if_modified(url, validator):
+    """ Opens a URL with a conditional request.
+    :param url: The URL of the resource.
+    :param validator: Dictionary with 'etag' and 'last_modified' of the cached resource, if any.
+    :return: Context manager for tuple of the response (None if not modified) and the validator for the response.
     """
-    url = url_format.format(*args)
+    headers = dict()
+    if 'etag' in validator:
+        headers['If-None-Match'] = validator['etag']
+    if 'last_modified' in validator:
+        headers['If-Modified-Since'] = validator['last_modified']
     log(LogLevel.fine, url)
-    with urlopen(url) as response:
-        return response.read()
+    with span('url_open_if_modified', category='url', url=url):
+        try:
+            response = urlopen(Request(url, headers=headers))
+        except HTTPError as e:
+            if e.code != 304:
+                raise e
+            response = None
+        if response is None:
+            yield None, validator
+            return
+        with response:
+            new_validator = {key: value for key, value in (('etag', response.headers.get('ETag')),
+                                                           ('last_modified', response.headers.get('Last-Modified')))
+                             if value is not None}
+            yield response, new_validator
 
 
 def mkdir(path, sudo=False):
@@ -89,6 +147,29 @@ def mkdir(path, sudo=False):
     return path
 
 
+@contextmanager
+def atomic_file(path, mode='wt'):
+    """ :param path: Path to the file to write.
+    :param mode: 'wt' for text, or 'wb' for binary.
+    :return: Context manager for a file object, which replaces the file at once on exit without errors. It is a
+    uniquely named temporary file next to the file, so that concurrent writers do not clash. The file gets the same
+    permissions as files created by open(), rather than the private ones of mkstemp.
+    """
+    directory, name = split(path)
+    descriptor, temporary_path = mkstemp(prefix='.{}.'.format(name), suffix='.tmp', dir=directory)
+    try:
+        fchmod(descriptor, 0o666 & ~file_mode_mask)
+        with open(descriptor, mode=mode) as file:
+            yield file
+        replace(temporary_path, path)
+    except BaseException:
+        try:
+            remove(temporary_path)
+        except FileNotFoundError:
+            pass
+        raise
+
+
 @contextmanager
 def workspace():
     """ :return: Context manager for a directory that can be used as workspace. """
@@ -97,30 +178,114 @@ def workspace():
 
 
 @contextmanager
-def advisory_lock(file):
+def advisory_lock(file, shared=False, description=None, timeout=None):
     """ :param file: File to get a lock.
+    :param shared: Whether to get a shared lock, which is compatible with other shared locks, instead of an exclusive
+    one.
+    :param description: What the lock protects. If given, a message is shown while waiting for the lock, and
+    LockTimeoutError is raised after the timeout. None means waiting silently without limit.
+    :param timeout: Seconds to wait for the lock. None means AUTOPKG_LOCK_TIMEOUT, and negative means without limit.
     :return: Context manager for advisory lock on the file.
     """
-    flock(file, LOCK_EX)
-    yield
-    flock(file, LOCK_UN)
+    operation = LOCK_SH if shared else LOCK_EX
+    if description is None:
+        flock(file, operation)
+    else:
+        wait_for_lock(file, operation, description, lock_timeout if timeout is None else timeout)
+    try:
+        yield
+    finally:
+        flock(file, LOCK_UN)
+
+
+def wait_for_lock(file, operation, description, timeout):
+    """ :param file: File to get a lock.
+    :param operation: LOCK_SH or LOCK_EX.
+    :param description: What the lock protects.
+    :param timeout: Seconds to wait for the lock. Negative to wait without limit.
+    """
+    try:
+        flock(file, operation | LOCK_NB)
+        return
+    except BlockingIOError:
+        pass
+    log(LogLevel.info, 'Waiting for {} to be released by another run of autopkg...', description)
+    deadline = time() + timeout
+    with span('wait for lock', category='lock', lock=description):
+        while timeout < 0 or time() < deadline:
+            sleep(LOCK_POLL_INTERVAL)
+            try:
+                flock(file, operation | LOCK_NB)
+                return
+            except BlockingIOError:
+                pass
+    raise LockTimeoutError(description, timeout)
+
+
+class LockTimeoutError(Exception):
+    """ Gave up waiting for a lock held by another process. """
+
+    def __init__(self, description, timeout):
+        """ :param description: What the lock protects.
+        :param timeout: Seconds waited for the lock.
+        """
+        self.description = description
+        self.timeout = timeout
+
+    def __str__(self):
+        return 'Timed out after {} second(s) waiting for {}'.format(self.timeout, self.description)
 
 
 @contextmanager
-def run_lock():
-    """ :return: Context manager for run lock. """
-    with open(join(mkdir(run_lock_home), repository_name), mode='a') as file:
-        with advisory_lock(file):
+def lock_file(name, shared=False, description=None):
+    """ :param name: The name of the lock file in the run lock directory.
+    :param shared: Whether to get a shared lock instead of an exclusive one.
+    :param description: What the lock protects, as for advisory_lock.
+    :return: Context manager for the lock.
+    """
+    with open(join(mkdir(run_lock_home), name), mode='a') as file:
+        with advisory_lock(file, shared=shared, description=description):
             yield
 
 
 @contextmanager
-def config(name):
+def run_lock():
+    """ :return: Context manager for run lock, which serializes the runs that change the repository. Read-only runs
+    do not take it, and rely on the locks of the configuration files and the repository database instead.
+    """
+    with lock_file(repository_name, description='the run lock of repository {}'.format(repository_name)):
+        yield
+
+
+@contextmanager
+def config(name, shared=False):
     """ :param name: Name of the configuration file.
+    :param shared: Whether to only read the file, allowing other readers at the same time.
     :return: Context manager for the configuration file.
     """
-    with open(join(mkdir(config_home), name + '.json'), mode='a+t') as file:
-        with advisory_lock(file):
+    with json_file(join(mkdir(config_home), name + '.json'), shared=shared,
+                   description='the {} configuration of repository {}'.format(name, repository_name)) as config_data:
+        yield config_data
+
+
+@contextmanager
+def cache(name):
+    """ :param name: Name of the cache file. Cache files are shared among repositories.
+    :return: Context manager for the cache file.
+    """
+    with json_file(join(mkdir(cache_home), name + '.json')) as config_data:
+        yield config_data
+
+
+@contextmanager
+def json_file(path, shared=False, description=None):
+    """ :param path: Path to the JSON file.
+    :param shared: Whether to only read the file, allowing other readers at the same time. Changes are not written.
+    :param description: What the file is, as for advisory_lock.
+    :return: Context manager for the ConfigData of the file, locked while in use.
+    """
+    with open(path, mode='a+t') as file:
+        with advisory_lock(file, shared=shared, description=description):
             file.seek(0)
             try:
                 json = loads(file.read())
@@ -128,7 +293,7 @@ def config(name):
                 json = None
             config_data = ConfigData(json)
             yield config_data
-            if config_data.json is not None:
+            if config_data.json is not None and not shared:
                 file.truncate(0)
                 file.seek(0)
                 file.write(dumps(config_data.json))
@@ -162,6 +327,12 @@ class LogLevel(Enum):
     debug = 6
 
 
+# Levels written to the log file, i.e. AUTOPKG_LOG_LEVEL and the less verbose ones.
+LOG_FILE_LEVELS = frozenset(level for level in LogLevel if level.value <= LogLevel[log_file_level].value)
+# The number of buffered log lines that triggers a flush regardless of the interval.
+LOG_BUFFER_LINES = 256
+
+
 LOG_LEVEL_TO_COLOR = {LogLevel.error: [31],
                       LogLevel.warn: [33],
                       LogLevel.info: [],
@@ -179,24 +350,95 @@ def color(text, codes):
     return '{}{}\033[0m'.format(''.join(['\033[{}m'.format(code) for code in codes]), text)
 
 
+COLOR_PATTERN = re_compile('\033\\[[0-9]+m')
+
+
 def remove_color(text):
     """ :param text: The text.
     :return: Text without color tags.
     """
-    return sub('\033\[[0-9]+m', '', text)
+    if '\033' not in text:
+        return text
+    return COLOR_PATTERN.sub('', text)
 
 
 def write_autoremovable(autoremovables):
-    path = join(mkdir(autoremovable_home), repository_name)
+    with atomic_file(join(mkdir(autoremovable_home), repository_name)) as f:
+        for autoremovable in autoremovables:
+            f.write('{}\n'.format(autoremovable))
+
+
+class LogSink:
+    """ Buffered log file. Flushed by a background thread every AUTOPKG_LOG_FLUSH_INTERVAL seconds, on errors, and at
+    exit. A non-positive interval flushes every entry.
+    """
+
+    def __init__(self, path, json_lines=False, interval=log_flush_interval):
+        """ :param path: Path to the log file.
+        :param json_lines: Whether to write each entry as a JSON object in a line or not.
+        :param interval: Seconds between periodic flushes.
+        """
+        self.file = open(path, mode='a+t')
+        self.json_lines = json_lines
+        self.interval = interval
+        self.buffer = list()
+        self.lock = Lock()
+        self.second = None
+        self.timestamp = None
+        self.closed = Event()
+        if interval > 0:
+            Thread(target=self.flush_periodically, daemon=True).start()
+        atexit_register(self.close)
+
+    def write(self, log_level, text):
+        """ :param log_level: The LogLevel.
+        :param text: The log content, without color tags.
+        """
+        second = int(time())
+        with self.lock:
+            if second != self.second:
+                self.second = second
+                self.timestamp = strftime('%Y-%m-%dT%H:%M:%S%z', localtime(second))
+            if self.json_lines:
+                line = dumps({'time': self.timestamp, 'level': log_level.name, 'message': text})
+            else:
+                line = '{}:{}\t{}'.format(self.timestamp, log_level.name, text)
+            self.buffer.append(line + '\n')
+            if self.interval <= 0 or log_level is LogLevel.error or len(self.buffer) >= LOG_BUFFER_LINES:
+                self.flush_buffer()
+
+    def flush(self):
+        """ Writes out the buffered entries. """
+        with self.lock:
+            self.flush_buffer()
+
+    def flush_buffer(self):
+        """ Writes out the buffered entries. The lock must be held. """
+        if len(self.buffer) == 0 or self.file.closed:
+            return
+        self.file.write(''.join(self.buffer))
+        self.file.flush()
+        self.buffer.clear()
+
+    def flush_periodically(self):
+        while not self.closed.wait(self.interval):
+            self.flush()
+
+    def close(self):
+        """ Flushes the buffered entries and closes the log file. """
+        self.closed.set()
+        with self.lock:
+            self.flush_buffer()
+            self.file.close()
+
+
+def log_sink():
+    """ :return: The LogSink for the log file of the repository. """
     try:
-        remove(path)
-    except FileNotFoundError:
-        pass
-    f = open(path, mode='wt')
-    for autoremovable in autoremovables:
-        f.write('{}\n'.format(autoremovable))
-    f.flush()
-    f.close()
+        return log_sink.sink
+    except AttributeError:
+        log_sink.sink = LogSink(join(mkdir(log_home), repository_name), json_lines=log_format == 'json')
+        return log_sink.sink
 
 
 def log(log_level, content, *args):
@@ -205,14 +447,13 @@ def log(log_level, content, *args):
     :param content: The log content.
     :param args: Arguments for the format string.
     """
-    try:
-        log.file
-    except AttributeError:
-        log.file = open(join(mkdir(log_home), repository_name), mode='a+t')
-    text = str(content).format(*args)
-    log.file.write('{}:{}\t{}\n'.format(strftime('%Y-%m-%dT%H:%M:%S%z'), log_level.name, remove_color(text)))
-    log.file.flush()
     codes = LOG_LEVEL_TO_COLOR[log_level]
+    to_file = log_level in LOG_FILE_LEVELS
+    if codes is None and not to_file:
+        return
+    text = str(content).format(*args)
+    if to_file:
+        log_sink().write(log_level, remove_color(text))
     if codes is None:
         return
     print(color(text, codes), file=stderr)
@@ -0,0 +1,334 @@
+#!/usr/bin/python3
+
+""" Synthetic-scale benchmarks for graph building and planning, without network access.
+
+Run from the root of the repository:
+
+    python3 -m benchmarks.benchmark [--shapes chain,fanout,...] [--sizes 100,1000,...] [--cases plan_closure,...]
+                                    [--save PATH] [--baseline PATH] [--tolerance RATIO]
+
+The default sizes take about a minute and a half. '--sizes 50000' is supported but takes several minutes: planning
+the chain of 50,000 packages alone takes about 30 s and 430 MiB.
+"""
+
+from argparse import ArgumentParser
+from contextlib import contextmanager
+from gc import collect
+from json import dump
+from json import load
+from os import close
+from os import devnull
+from os import dup
+from os import dup2
+from os import open as os_open
+from os import O_WRONLY
+from os.path import join
+from random import Random
+from sys import exit
+from sys import stderr
+from tempfile import TemporaryDirectory
+from time import perf_counter
+from tracemalloc import start as tracemalloc_start
+from tracemalloc import stop as tracemalloc_stop
+from tracemalloc import get_traced_memory
+from autopkg.backends import AbstractBuildable
+from autopkg.backends import SourceReference
+from autopkg.builder import autoremovable_packages
+from autopkg.front import log_graph
+from autopkg.graph import build_dependency_graph
+from autopkg.package import PackageInfo
+from autopkg.package import PackageTinyInfo
+from autopkg.plan import convert_graph_to_plans
+from autopkg.utils import LogSink
+from autopkg.utils import log_sink
+
+
+SHAPES = ['chain', 'fanout', 'diamond', 'split', 'case']
+# Sizes run by default. Larger ones can be given with --sizes.
+SIZES = [100, 1000, 10000]
+PHASES = ['build_dependency_graph', 'convert_graph_to_plans', 'autoremovable_packages', 'log_graph']
+# Deep graphs make the requisites of plans quadratic in size, so chains are cut at this length.
+CHAIN_LENGTH = 1000
+# The number of layers of diamond-like graphs.
+NUM_LAYERS = 12
+# Phases faster than this are not checked against the baseline, since they are dominated by noise.
+MIN_CHECKED_SECONDS = 0.01
+OFFICIAL_PKGNAMES = ['glibc', 'gcc-libs', 'zlib', 'python', 'qt5-base']
+# The number of packages in the graph planned by the plan_closure case.
+CLOSURE_CASE_SIZE = 5000
+# The number of packages in the graph measured by the graph_memory case.
+MEMORY_CASE_SIZE = 20000
+
+
+class FakeBuildable(AbstractBuildable):
+    """ Buildable from the fake backend. """
+
+    def __init__(self, package_info):
+        """ :param package_info: The PackageInfo. """
+        super().__init__(package_info, SourceReference('fake', package_info.pkgbase))
+
+    @property
+    def chroot_required(self):
+        """ :return: False. """
+        return False
+
+
+class FakeRepository:
+    """ In-memory stand-in for Repository, with only what planning reads. """
+
+    def __init__(self, packages):
+        """ :param packages: Dictionary from pkgname to PackageTinyInfo. """
+        self.packages = packages
+
+
+def fake_backend(buildables):
+    """ :param buildables: List of Buildables to serve.
+    :return: Backend that finds the Buildables by pkgname, ignoring case as the AUR does.
+    """
+    lower_to_buildable = {buildable.package_info.pkgname.lower(): buildable for buildable in buildables}
+
+    def backend(pkgnames):
+        return [lower_to_buildable[pkgname.lower()] for pkgname in pkgnames if pkgname.lower() in lower_to_buildable]
+    backend.__name__ = 'fake_backend'
+    return backend
+
+
+def layered(size, random, width=None):
+    """ :param size: The number of packages.
+    :param random: The Random.
+    :param width: The number of packages in a layer. Defaults to size / NUM_LAYERS.
+    :return: List of lists of pkgnames that each package depends on. Each package depends on a few packages nearby in
+    the next layer, so that dependencies share their own dependencies (diamonds) while closures stay realistic.
+    """
+    width = width or max(1, size // NUM_LAYERS)
+    dependencies = list()
+    for index in range(size):
+        layer, position = divmod(index, width)
+        next_layer = (layer + 1) * width
+        candidates = [next_layer + (position + offset) % width for offset in range(4)]
+        candidates = [candidate for candidate in candidates if candidate < size]
+        dependencies.append(random.sample(candidates, min(len(candidates), random.randint(1, 3))))
+    return dependencies
+
+
+def generate(shape, size, seed=0):
+    """ :param shape: One of SHAPES.
+    :param size: The number of packages.
+    :param seed: Seed for the Random.
+    :return: Tuple of the list of target pkgnames, the list of Buildables, and the FakeRepository.
+    """
+    random = Random(seed)
+    pkgnames = ['{}-{}'.format(shape, index) for index in range(size)]
+    pkgbases = list(pkgnames)
+    if shape == 'chain':
+        dependencies = [[index + 1] if (index + 1) % CHAIN_LENGTH != 0 and index + 1 < size else []
+                        for index in range(size)]
+        targets = [pkgnames[index] for index in range(0, size, CHAIN_LENGTH)]
+    elif shape == 'fanout':
+        dependencies = [list(range(1, size))] + [[] for index in range(1, size)]
+        targets = [pkgnames[0]]
+    elif shape == 'diamond' or shape == 'case':
+        dependencies = layered(size, random)
+        targets = pkgnames[:max(1, size // NUM_LAYERS)]
+    elif shape == 'split':
+        # Four packages from each pkgbase, depending on the same kind of packages from pkgbases of the next layer.
+        base_dependencies = layered((size + 3) // 4, random)
+        pkgbases = ['split-{}'.format(index // 4) for index in range(size)]
+        dependencies = [[base * 4 + index % 4 for base in base_dependencies[index // 4] if base * 4 + index % 4 < size]
+                        for index in range(size)]
+        targets = pkgnames[:max(1, size // NUM_LAYERS)]
+    else:
+        raise Exception('Unknown shape: {}'.format(shape))
+    buildables = list()
+    packages = dict()
+    for index, pkgname in enumerate(pkgnames):
+        depends = [pkgnames[dependency] for dependency in dependencies[index]]
+        if shape == 'case':
+            # Refer to the same package with different cases.
+            depends = [dependency.upper() if random.random() < 0.5 else dependency for dependency in depends]
+        depends.append(random.choice(OFFICIAL_PKGNAMES))
+        makedepends = depends[:1] if index % 2 == 0 else []
+        buildables.append(FakeBuildable(PackageInfo(pkgname, '1.{}-1'.format(index % 7), pkgbase=pkgbases[index],
+                                                    depends=depends, makedepends=makedepends)))
+        # A third is up to date, a third is outdated, and a third is new.
+        if index % 3 == 0:
+            packages[pkgname] = PackageTinyInfo(pkgname, '1.{}-1'.format(index % 7))
+        elif index % 3 == 1:
+            packages[pkgname] = PackageTinyInfo(pkgname, '0.{}-1'.format(index % 7))
+    for index in range(max(1, size // 20)):
+        # Packages no longer needed.
+        pkgname = '{}-stale-{}'.format(shape, index)
+        packages[pkgname] = PackageTinyInfo(pkgname, '1.0-1')
+    return targets, buildables, FakeRepository(packages)
+
+
+@contextmanager
+def silenced():
+    """ :return: Context manager in which the standard error (where logs are printed) is discarded. """
+    stderr.flush()
+    saved = dup(2)
+    null = os_open(devnull, O_WRONLY)
+    dup2(null, 2)
+    try:
+        yield
+    finally:
+        stderr.flush()
+        dup2(saved, 2)
+        close(null)
+        close(saved)
+
+
+def run_phases(targets, buildables, repository, measure_memory):
+    """ :param targets: List of target pkgnames.
+    :param buildables: List of Buildables for the fake backend.
+    :param repository: The FakeRepository.
+    :param measure_memory: Whether to measure peak memory, which slows down execution, instead of time.
+    :return: Dictionary from the name of each phase to the seconds or the peak bytes.
+    """
+    backends = [fake_backend(buildables), lambda pkgnames: []]
+    results = dict()
+    state = dict()
+
+    def phase(name, function):
+        if measure_memory:
+            tracemalloc_start()
+            state[name] = function()
+            results[name] = get_traced_memory()[1]
+            tracemalloc_stop()
+        else:
+            start = perf_counter()
+            state[name] = function()
+            results[name] = perf_counter() - start
+
+    phase('build_dependency_graph', lambda: build_dependency_graph(targets, backends))
+    graph = state['build_dependency_graph']
+    phase('convert_graph_to_plans', lambda: convert_graph_to_plans(graph, repository))
+    plans = state['convert_graph_to_plans']
+    phase('autoremovable_packages', lambda: autoremovable_packages(plans, repository))
+    with silenced():
+        phase('log_graph', lambda: log_graph(graph, repository))
+    return results
+
+
+def plan_closure_case():
+    """ Plans a diamond-heavy graph, where many plans share the closures of their requisites.
+    :return: Dictionary with the seconds taken by convert_graph_to_plans.
+    """
+    targets, buildables, repository = generate('diamond', CLOSURE_CASE_SIZE)
+    graph = build_dependency_graph(targets, [fake_backend(buildables), lambda pkgnames: []])
+    start = perf_counter()
+    with silenced():
+        convert_graph_to_plans(graph, repository)
+    return {'seconds': perf_counter() - start}
+
+
+def graph_memory_case():
+    """ Builds a dependency graph, with the package information created by the backend as part of it.
+    :return: Dictionary with the bytes retained by the graph.
+    """
+    collect()
+    tracemalloc_start()
+    try:
+        targets, buildables, repository = generate('diamond', MEMORY_CASE_SIZE)
+        graph = build_dependency_graph(targets, [fake_backend(buildables), lambda pkgnames: []])
+        del targets, buildables, repository
+        collect()
+        retained = get_traced_memory()[0]
+    finally:
+        tracemalloc_stop()
+    del graph
+    return {'bytes': retained}
+
+
+CASES = {'plan_closure': (CLOSURE_CASE_SIZE, plan_closure_case), 'graph_memory': (MEMORY_CASE_SIZE, graph_memory_case)}
+
+
+def benchmark_cases(names):
+    """ :param names: List of names of CASES to run.
+    :return: Dictionary from 'case/name/size' to the dictionary with 'seconds' or 'bytes', whichever the case measures.
+    """
+    results = dict()
+    for name in names:
+        size, case = CASES[name]
+        key = 'case/{}/{}'.format(name, size)
+        results[key] = case()
+        if 'seconds' in results[key]:
+            print('{:40} {:10.3f} s'.format(key, results[key]['seconds']), flush=True)
+        if 'bytes' in results[key]:
+            print('{:40} {:10.1f} MiB'.format(key, results[key]['bytes'] / 2 ** 20), flush=True)
+    return results
+
+
+def benchmark(shapes, sizes):
+    """ :param shapes: List of shapes to generate.
+    :param sizes: List of the numbers of packages.
+    :return: Dictionary from 'shape/size/phase' to the dictionary with 'seconds' and 'bytes'.
+    """
+    results = dict()
+    for shape in shapes:
+        for size in sizes:
+            generated = generate(shape, size)
+            seconds = run_phases(*generated, measure_memory=False)
+            peaks = run_phases(*generate(shape, size), measure_memory=True)
+            for name in PHASES:
+                key = '{}/{}/{}'.format(shape, size, name)
+                results[key] = {'seconds': seconds[name], 'bytes': peaks[name]}
+                print('{:40} {:10.3f} s {:10.1f} MiB'.format(key, seconds[name], peaks[name] / 2 ** 20), flush=True)
+    return results
+
+
+def regressions(results, baseline, tolerance):
+    """ :param results: Results from benchmark.
+    :param baseline: Results from an earlier benchmark.
+    :param tolerance: Allowed ratio of increase over the baseline.
+    :return: List of descriptions of regressions.
+    """
+    found = list()
+    for key, result in results.items():
+        if key not in baseline:
+            continue
+        base = baseline[key]
+        if 'seconds' in result and 'seconds' in base and result['seconds'] >= MIN_CHECKED_SECONDS and \
+                result['seconds'] > base['seconds'] * (1 + tolerance):
+            found.append('{}: {:.3f} s → {:.3f} s'.format(key, base['seconds'], result['seconds']))
+        if 'bytes' in result and 'bytes' in base and result['bytes'] > base['bytes'] * (1 + tolerance):
+            found.append('{}: {:.1f} MiB → {:.1f} MiB'.format(key, base['bytes'] / 2 ** 20,
+                                                              result['bytes'] / 2 ** 20))
+    return found
+
+
+def main():
+    parser = ArgumentParser(prog='python3 -m benchmarks.benchmark',
+                            description='Benchmarks graph building and planning with synthetic packages.')
+    parser.add_argument('--shapes', default=','.join(SHAPES), help='Comma-separated shapes of dependency graphs.')
+    parser.add_argument('--sizes', default=','.join(str(size) for size in SIZES),
+                        help='Comma-separated numbers of packages. 50000 takes several minutes.')
+    parser.add_argument('--cases', default=','.join(CASES),
+                        help='Comma-separated named cases: plan_closure times planning {} packages with shared '
+                             'closures, and graph_memory measures the memory retained by a graph of {} packages. '
+                             'Empty to skip.'.format(CLOSURE_CASE_SIZE, MEMORY_CASE_SIZE))
+    parser.add_argument('--save', help='Path to save the results to, as a baseline for later runs.')
+    parser.add_argument('--baseline', help='Path to the results of an earlier run to check for regressions.')
+    parser.add_argument('--tolerance', type=float, default=0.5,
+                        help='Allowed ratio of increase in time or memory over the baseline.')
+    arguments = parser.parse_args()
+    with TemporaryDirectory() as path:
+        # Keep the logs of the benchmark out of the log file of the repository.
+        log_sink.sink = LogSink(join(path, 'log'))
+        results = benchmark(arguments.shapes.split(','), [int(size) for size in arguments.sizes.split(',')])
+        results.update(benchmark_cases([name for name in arguments.cases.split(',') if len(name) > 0]))
+        log_sink.sink.close()
+    if arguments.save:
+        with open(arguments.save, mode='wt') as file:
+            dump(results, file, indent=1, sort_keys=True)
+    if arguments.baseline:
+        with open(arguments.baseline) as file:
+            found = regressions(results, load(file), arguments.tolerance)
+        for regression in found:
+            print('Regression: {}'.format(regression))
+        if len(found) > 0:
+            exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+#!/usr/bin/python3
+
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from json import dumps
+from os import environ
+from tempfile import mkdtemp
+from threading import Lock
+from threading import Thread
+from unittest import TestCase
+from unittest import main
+from urllib.parse import parse_qs
+from urllib.parse import urlsplit
+
+# Keep the logs of the tests away from ~/.autopkg.
+environ.setdefault('AUTOPKG_HOME', mkdtemp(prefix='autopkg-test-'))
+
+from autopkg.aur import aur_rpc_info  # noqa: E402
+from autopkg.aur import chunk_rpc_paths  # noqa: E402
+
+
+MAX_URL_LENGTH = 4000
+NUM_PACKAGES = 1001
+# Packages the fake server does not know.
+MISSING = {'package-0007', 'package-0500'}
+
+
+class FakeRPCHandler(BaseHTTPRequestHandler):
+    """ Answers RPC info queries with the known packages in reverse order, over keep-alive connections. """
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        pkgnames = parse_qs(urlsplit(self.path).query).get('arg[]', list())
+        with self.server.lock:
+            self.server.paths.append(self.path)
+            self.server.client_ports.add(self.client_address[1])
+        results = [{'Name': pkgname, 'Version': '1.0-1'} for pkgname in reversed(pkgnames) if pkgname not in MISSING]
+        body = dumps({'version': 5, 'type': 'multiinfo', 'resultcount': len(results), 'results': results}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class AURRPCTest(TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), FakeRPCHandler)
+        self.server.lock = Lock()
+        self.server.paths = list()
+        self.server.client_ports = set()
+        Thread(target=self.server.serve_forever, daemon=True).start()
+        self.rpc_url = 'http://127.0.0.1:{}/rpc/?v=5&type=info'.format(self.server.server_address[1])
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_chunks_within_url_length(self):
+        pkgnames = ['package-{:04d}'.format(index) for index in range(NUM_PACKAGES)] + ['c++', 'a&b']
+        paths = chunk_rpc_paths('/rpc/?v=5&type=info', pkgnames, MAX_URL_LENGTH)
+        self.assertGreater(len(paths), 1)
+        for path in paths:
+            self.assertLessEqual(len(path), MAX_URL_LENGTH)
+        self.assertEqual([pkgname for path in paths for pkgname in parse_qs(urlsplit(path).query)['arg[]']],
+                         pkgnames)
+
+    def test_results_in_order(self):
+        pkgnames = ['package-{:04d}'.format(index) for index in range(NUM_PACKAGES)]
+        results = aur_rpc_info(pkgnames, rpc_url=self.rpc_url, max_url_length=MAX_URL_LENGTH, connections=4)
+        self.assertEqual([result['Name'] for result in results],
+                         [pkgname for pkgname in pkgnames if pkgname not in MISSING])
+        queried = [pkgname for path in self.server.paths for pkgname in parse_qs(urlsplit(path).query)['arg[]']]
+        self.assertEqual(sorted(queried), pkgnames)
+        for path in self.server.paths:
+            self.assertLessEqual(len(path), MAX_URL_LENGTH)
+
+    def test_connections_reused(self):
+        pkgnames = ['package-{:04d}'.format(index) for index in range(NUM_PACKAGES)]
+        aur_rpc_info(pkgnames, rpc_url=self.rpc_url, max_url_length=MAX_URL_LENGTH, connections=4)
+        aur_rpc_info(pkgnames, rpc_url=self.rpc_url, max_url_length=MAX_URL_LENGTH, connections=4)
+        self.assertGreater(len(self.server.paths), 8)
+        self.assertLessEqual(len(self.server.client_ports), 4)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,146 @@
+#!/usr/bin/python3
+
+from os import environ
+from os.path import exists
+from os.path import join
+from subprocess import run
+from subprocess import PIPE
+from tempfile import TemporaryDirectory
+from tempfile import mkdtemp
+from unittest import TestCase
+from unittest import main
+
+# Keep the logs, caches and mirrors of the tests away from ~/.autopkg.
+environ.setdefault('AUTOPKG_HOME', mkdtemp(prefix='autopkg-test-'))
+
+from autopkg import mirror  # noqa: E402
+from autopkg.backends import current_tokens  # noqa: E402
+from autopkg.backends import do_git  # noqa: E402
+from autopkg.backends import git_sources  # noqa: E402
+from autopkg.backends import recorded_token  # noqa: E402
+from autopkg.metadata import MetadataCache  # noqa: E402
+from autopkg.metadata import metadata_caches  # noqa: E402
+from autopkg.mirror import git_mirror  # noqa: E402
+from autopkg.mirror import mirror_checkout  # noqa: E402
+from autopkg.mirror import mirror_commit  # noqa: E402
+from autopkg.mirror import remote_commit  # noqa: E402
+from autopkg.mirror import remote_refs  # noqa: E402
+
+
+PKGBUILD_FORMAT = """pkgname=test-package
+pkgver={}
+pkgrel=1
+arch=('any')
+depends=('glibc>=2.0')
+"""
+
+
+def git(*arguments, cwd=None):
+    """ :param arguments: Arguments to git.
+    :param cwd: Working directory.
+    :return: The standard output, stripped.
+    """
+    command = ['git', '-c', 'user.name=autopkg', '-c', 'user.email=autopkg@localhost'] + list(arguments)
+    return run(command, cwd=cwd, stdout=PIPE, check=True, universal_newlines=True).stdout.strip()
+
+
+class GitSourceTest(TestCase):
+    def setUp(self):
+        self.directory = TemporaryDirectory()
+        self.bare = join(self.directory.name, 'origin.git')
+        self.work = join(self.directory.name, 'work')
+        git('init', '--quiet', '--bare', self.bare)
+        git('symbolic-ref', 'HEAD', 'refs/heads/master', cwd=self.bare)
+        git('init', '--quiet', self.work)
+        self.url = 'file://' + self.bare
+        self.commit_pkgbuild('1.0')
+        mirror.updated_mirrors.clear()
+        metadata_caches['git'] = MetadataCache('git', ttl=0)
+
+    def tearDown(self):
+        self.directory.cleanup()
+        try:
+            del git_sources.sources
+        except AttributeError:
+            pass
+
+    def commit_pkgbuild(self, pkgver):
+        """ Commits a PKGBUILD with the pkgver under 'package' and pushes it to master of the bare repository.
+        :param pkgver: The pkgver.
+        :return: The commit id.
+        """
+        git('checkout', '--quiet', '-B', 'master', cwd=self.work)
+        run(['mkdir', '-p', join(self.work, 'package')], check=True)
+        with open(join(self.work, 'package', 'PKGBUILD'), 'w') as file:
+            file.write(PKGBUILD_FORMAT.format(pkgver))
+        git('add', '-A', cwd=self.work)
+        git('commit', '--quiet', '-m', pkgver, cwd=self.work)
+        git('push', '--quiet', '--force', self.bare, 'master:master', cwd=self.work)
+        return git('rev-parse', 'HEAD', cwd=self.work)
+
+    def test_remote_refs(self):
+        commit = git('rev-parse', 'HEAD', cwd=self.work)
+        git('tag', 'v1.0', cwd=self.work)
+        git('tag', '-a', '-m', 'annotated', 'v1.0-annotated', cwd=self.work)
+        git('push', '--quiet', '--tags', self.bare, cwd=self.work)
+        refs = remote_refs([self.url])[self.url]
+        self.assertEqual(remote_commit(refs, 'master'), commit)
+        self.assertEqual(remote_commit(refs, 'v1.0'), commit)
+        self.assertEqual(remote_commit(refs, 'v1.0-annotated'), commit)
+        self.assertIsNone(remote_commit(refs, commit))
+        self.assertIsNone(remote_commit(refs, 'missing'))
+
+    def test_remote_refs_of_missing_repository(self):
+        url = 'file://' + join(self.directory.name, 'missing.git')
+        self.assertEqual(remote_refs([url]), {url: dict()})
+
+    def test_new_commit_changes_remote_commit(self):
+        old_commit = remote_commit(remote_refs([self.url])[self.url], 'master')
+        new_commit = self.commit_pkgbuild('1.1')
+        self.assertNotEqual(new_commit, old_commit)
+        self.assertEqual(remote_commit(remote_refs([self.url])[self.url], 'master'), new_commit)
+
+    def test_mirror_checkout(self):
+        old_commit = git('rev-parse', 'HEAD', cwd=self.work)
+        self.commit_pkgbuild('1.1')
+        path = git_mirror(self.url)
+        self.assertEqual(mirror_commit(path, old_commit), old_commit)
+        for shared in [True, False]:
+            with self.subTest(shared=shared), TemporaryDirectory() as workspace:
+                mirror_checkout(path, old_commit, workspace, shared=shared)
+                with open(join(workspace, 'package', 'PKGBUILD')) as file:
+                    self.assertIn('pkgver=1.0\n', file.read())
+                self.assertEqual(exists(join(workspace, '.git', 'objects', 'info', 'alternates')), shared)
+
+    def test_new_commit_invalidates_metadata(self):
+        git_sources.sources = [{'repository': self.url, 'path': 'package', 'branch': 'master'}]
+        metadata = metadata_caches['git']
+        buildable = do_git()['test-package']
+        self.assertEqual(str(buildable.package_info.version), '1.0-1')
+        self.assertEqual(buildable.package_info.depends, ['glibc'])
+        self.assertEqual((metadata.hits, metadata.misses), (0, 1))
+
+        buildable = do_git()['test-package']
+        self.assertEqual(str(buildable.package_info.version), '1.0-1')
+        self.assertEqual((metadata.hits, metadata.misses), (1, 1))
+
+        self.commit_pkgbuild('1.1')
+        mirror.updated_mirrors.clear()
+        buildable = do_git()['test-package']
+        self.assertEqual(str(buildable.package_info.version), '1.1-1')
+        self.assertEqual((metadata.hits, metadata.misses), (1, 2))
+
+    def test_current_tokens_follow_do_git(self):
+        old_commit = git('rev-parse', 'HEAD', cwd=self.work)
+        buildables = list()
+        for branch in ['master', old_commit]:
+            git_sources.sources = [{'repository': self.url, 'path': 'package', 'branch': branch}]
+            buildables.append(do_git()['test-package'])
+        self.assertEqual(current_tokens(buildables), [recorded_token(buildable) for buildable in buildables])
+        new_commit = self.commit_pkgbuild('1.1')
+        mirror.updated_mirrors.clear()
+        self.assertEqual(current_tokens(buildables), [new_commit, old_commit])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,149 @@
+#!/usr/bin/python3
+
+from io import BytesIO
+from os import environ
+from os import listdir
+from os import readlink
+from os.path import join
+from shutil import which
+from subprocess import run
+from subprocess import DEVNULL
+from tarfile import open as tarfile_open
+from tarfile import TarInfo
+from tarfile import DIRTYPE
+from tempfile import TemporaryDirectory
+from tempfile import mkdtemp
+from unittest import TestCase
+from unittest import main
+from unittest import skipUnless
+
+# Keep the logs of the tests away from ~/.autopkg.
+environ.setdefault('AUTOPKG_HOME', mkdtemp(prefix='autopkg-test-'))
+
+from autopkg.repodb import read_repodb  # noqa: E402
+from autopkg.repodb import read_entries  # noqa: E402
+from autopkg.repodb import write_repodb  # noqa: E402
+from autopkg.repodb import package_entry  # noqa: E402
+from autopkg.repodb import parse_desc  # noqa: E402
+from autopkg.repository import Repository  # noqa: E402
+
+
+# pkgname, version, .PKGINFO lines other than the name and the version, and the paths in the package.
+PACKAGES = [('alpha', '1.0-1', ['pkgdesc = The first package', 'url = https://example.com/alpha', 'license = MIT',
+                                'license = Apache-2.0', 'depend = glibc', 'depend = beta>=2.0',
+                                'optdepend = gamma: for extra features', 'makedepend = cmake', 'provides = libalpha.so',
+                                'group = test-group'],
+             ['usr/', 'usr/bin/', 'usr/bin/alpha', 'usr/share/', 'usr/share/alpha/', 'usr/share/alpha/data']),
+            ('beta', '1:2.5.r3.gabcdef0-2', ['pkgbase = beta-git', 'pkgdesc = Split from a VCS package',
+                                             'conflict = beta', 'replaces = beta-old', 'checkdepend = python'],
+             ['usr/', 'usr/lib/', 'usr/lib/libbeta.so', 'usr/lib/libbeta.so.2']),
+            ('gamma', '20240101-1', [], ['etc/', 'etc/gamma.conf'])]
+
+
+def make_package(directory, pkgname, version, pkginfo_lines, paths):
+    """ Writes a minimal package file, as makepkg would.
+    :param directory: The directory to write the package file to.
+    :param pkgname: The name of the package.
+    :param version: The version.
+    :param pkginfo_lines: Lines of .PKGINFO other than pkgname and pkgver.
+    :param paths: The paths in the package. Directories end with '/'.
+    :return: The path to the package file.
+    """
+    pkginfo = ['# Generated by makepkg', 'pkgname = ' + pkgname, 'pkgver = ' + version, 'builddate = 1700000000',
+               'packager = Unknown Packager', 'size = 12345', 'arch = x86_64']
+    if not any(line.startswith('pkgbase = ') for line in pkginfo_lines):
+        pkginfo.append('pkgbase = ' + pkgname)
+    path = join(directory, '{}-{}-x86_64.pkg.tar.xz'.format(pkgname, version))
+    with tarfile_open(path, mode='w:xz') as tar:
+        members = [('.PKGINFO', '\n'.join(pkginfo + pkginfo_lines) + '\n'), ('.MTREE', '')]
+        for member_name, content in members:
+            info = TarInfo(member_name)
+            info.size = len(content.encode())
+            tar.addfile(info, BytesIO(content.encode()))
+        for member_name in paths:
+            info = TarInfo(member_name.rstrip('/'))
+            if member_name.endswith('/'):
+                info.type = DIRTYPE
+                info.mode = 0o755
+                tar.addfile(info)
+            else:
+                content = member_name.encode()
+                info.size = len(content)
+                tar.addfile(info, BytesIO(content))
+    return path
+
+
+class RepoDBTest(TestCase):
+    def setUp(self):
+        self.directory = TemporaryDirectory()
+        self.package_file_paths = [make_package(self.directory.name, *package) for package in PACKAGES]
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_package_entry(self):
+        entry = package_entry(self.package_file_paths[1])
+        self.assertEqual(entry.directory_name, 'beta-1:2.5.r3.gabcdef0-2')
+        self.assertEqual((entry.name, entry.version), ('beta', '1:2.5.r3.gabcdef0-2'))
+        self.assertEqual(entry.filename, 'beta-1:2.5.r3.gabcdef0-2-x86_64.pkg.tar.xz')
+        self.assertEqual(entry.fields['BASE'], ['beta-git'])
+        self.assertEqual(entry.fields['REPLACES'], ['beta-old'])
+        self.assertNotIn('DEPENDS', entry.fields)
+        self.assertEqual(parse_desc(entry.files)['FILES'], PACKAGES[1][3])
+
+    def test_round_trip(self):
+        db_path = join(self.directory.name, 'test.files.tar.gz')
+        entries = [package_entry(path) for path in self.package_file_paths]
+        write_repodb(db_path, entries, with_files=True)
+        self.assertEqual(readlink(join(self.directory.name, 'test.files')), 'test.files.tar.gz')
+        read = read_entries(db_path, with_files=True)
+        self.assertEqual(list(read.keys()), ['alpha', 'beta', 'gamma'])
+        for entry in entries:
+            self.assertEqual(read[entry.name].directory_name, entry.directory_name)
+            self.assertEqual(read[entry.name].desc, entry.desc)
+            self.assertEqual(read[entry.name].files, entry.files)
+
+        rewritten_path = join(self.directory.name, 'rewritten.files.tar.gz')
+        write_repodb(rewritten_path, read.values(), with_files=True)
+        self.assertEqual(read_repodb(rewritten_path, ('desc', 'files')), read_repodb(db_path, ('desc', 'files')))
+        self.assertEqual([name for name in listdir(self.directory.name) if name.endswith('.tmp')], [])
+
+    def test_repository_update(self):
+        repository_directory = join(self.directory.name, 'repository')
+        run(['mkdir', repository_directory], check=True)
+        repository = Repository('test', repository_directory)
+        with repository.transaction():
+            for path in self.package_file_paths:
+                repository.add(path)
+        repository.remove('gamma')
+        newer_path = make_package(self.directory.name, 'alpha', '1.1-1', PACKAGES[0][2], PACKAGES[0][3])
+        repository.add(newer_path)
+
+        entries = read_entries(repository.db_path)
+        files_entries = read_entries(repository.files_db_path, with_files=True)
+        self.assertEqual(sorted(entries.keys()), ['alpha', 'beta'])
+        self.assertEqual(sorted(files_entries.keys()), ['alpha', 'beta'])
+        self.assertEqual(entries['alpha'].version, '1.1-1')
+        self.assertEqual(files_entries['alpha'].desc, entries['alpha'].desc)
+        self.assertEqual(sorted(name for name in listdir(repository_directory) if '.pkg.tar' in name),
+                         ['alpha-1.1-1-x86_64.pkg.tar.xz', 'beta-1:2.5.r3.gabcdef0-2-x86_64.pkg.tar.xz'])
+        self.assertEqual(sorted(Repository('test', repository_directory).packages.keys()), ['alpha', 'beta'])
+
+    @skipUnless(which('repo-add'), 'repo-add(8) is not installed')
+    def test_against_repo_add(self):
+        repo_add_path = join(self.directory.name, 'repo-add.db.tar.gz')
+        run(['repo-add', repo_add_path] + self.package_file_paths, stdout=DEVNULL, check=True)
+        expected = read_entries(join(self.directory.name, 'repo-add.files.tar.gz'), with_files=True)
+        db_path = join(self.directory.name, 'test.files.tar.gz')
+        write_repodb(db_path, [package_entry(path) for path in self.package_file_paths], with_files=True)
+        actual = read_entries(db_path, with_files=True)
+        self.assertEqual(sorted(actual.keys()), sorted(expected.keys()))
+        for pkgname, entry in expected.items():
+            with self.subTest(pkgname=pkgname):
+                self.assertEqual(actual[pkgname].directory_name, entry.directory_name)
+                self.assertEqual(actual[pkgname].fields, entry.fields)
+                self.assertEqual(parse_desc(actual[pkgname].files), parse_desc(entry.files))
+
+
+if __name__ == '__main__':
+    main()
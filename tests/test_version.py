@@ -0,0 +1,88 @@
+#!/usr/bin/python3
+
+from itertools import combinations
+from random import Random
+from shutil import which
+from subprocess import run
+from subprocess import PIPE
+from unittest import TestCase
+from unittest import main
+from unittest import skipUnless
+from autopkg.package import Version
+
+
+# Cases from pacman's vercmptest.sh, with the expected sign of vercmp(a, b).
+KNOWN_CASES = [('1.5.0', '1.5.0', 0), ('1.5.1', '1.5.0', 1),
+               ('1.5.1', '1.5', 1),
+               ('1.5.0-1', '1.5.0-1', 0), ('1.5.0-1', '1.5.0-2', -1), ('1.5.0-1', '1.5.1-1', -1),
+               ('1.5.0-2', '1.5.1-1', -1),
+               ('1.5-1', '1.5', 0), ('1.5-1', '1.5-2', -1),
+               ('1.1-1', '1.1', 0), ('1.1', '1.1-1', 0),
+               ('1.5b-1', '1.5-1', -1), ('1.5b', '1.5', -1), ('1.5b-1', '1.5', -1), ('1.5b', '1.5.1', -1),
+               ('1.0a', '1.0alpha', -1), ('1.0alpha', '1.0b', -1), ('1.0b', '1.0beta', -1),
+               ('1.0beta', '1.0rc', -1), ('1.0rc', '1.0', -1),
+               ('1.5.a', '1.5', 1), ('1.5.b', '1.5.a', 1), ('1.5.1', '1.5.b', 1),
+               ('1.5.b-1', '1.5.b', 0), ('1.5-1', '1.5.b', -1),
+               ('2.0', '2_0', 0), ('2.0_a', '2_0.a', 0), ('2.0a', '2.0.a', -1), ('2___a', '2_a', 1),
+               ('1:1.0', '1.0', 1), ('1:1.0', '1.1', 1), ('1:1.1', '1.1', 1), ('0:1.0', '1.0', 0),
+               ('0:1.0', '1.1', -1), ('1:1.1', '2:1.1', -1), ('1:1.0', '2:1.1', -1), ('2:1.1', '1:1.1', 1),
+               ('1.0-1', '1.0-1.1', -1), ('1.0-1.1', '1.0-1.2', -1), ('1.0-1.1', '1.0-1.1.1', -1)]
+# Versions in the shapes real packages use: releases, pre-releases, VCS snapshots, dates, epochs and pkgrels.
+REAL_VERSIONS = ['1.2.3', '1.2.3-1', '1.2.3-2', '1.2.3.1-1', '1.2.10-1', '1.2.3rc1-1', '1.2.3rc2-1', '1.2.3alpha-1',
+                 '1.2.3beta2-1', '1.2.3.r0.g1a2b3c4-1', '1.2.3.r12.gabcdef0-1', '1.2.3.r12.gabcdef0-2',
+                 'r123.abcdef0-1', 'r124.0123456-1', '20240101-1', '20231231-1', '20240101.1-1', '2024.01.01-1',
+                 '1:1.0-1', '1:1.2.3-1', '2:0.1-1', '0.9.9-1', '0.10.0-1', '1.0.0_pre3-1', '1.0.0+2+g1234567-1',
+                 '6.8.9.arch1-1', '6.8.10.arch1-1', '6.9rc1-1', '3.12.2-1', '3.12.2-1.1', '2.40.1-1', '4.19.1+dfsg-1',
+                 '1.2.3.post1-1', '1.2.3~rc1-1', '0.0.0+git20240101-1', '1.0a-1', '1.0-1', '1.0.0-1', '1.0b-1']
+# Characters that exercise digits, letters, separators and epochs.
+ALPHABET = '0123456789ab._+~'
+NUM_RANDOM_PAIRS = 2000
+
+
+def sign(number):
+    return (number > 0) - (number < 0)
+
+
+def random_version(random):
+    """ :param random: The Random.
+    :return: A random version string, sometimes with an epoch and a pkgrel.
+    """
+    pkgver = ''.join(random.choice(ALPHABET) for _ in range(random.randint(1, 8)))
+    epoch = '{}:'.format(random.randint(0, 2)) if random.random() < 0.2 else ''
+    pkgrel = '-{}'.format(random.randint(1, 3)) if random.random() < 0.5 else ''
+    return epoch + pkgver + pkgrel
+
+
+class VersionTest(TestCase):
+    def test_known_cases(self):
+        for a, b, expected in KNOWN_CASES:
+            with self.subTest(a=a, b=b):
+                self.assertEqual(sign(Version(a).cmp(Version(b))), expected)
+                self.assertEqual(sign(Version(b).cmp(Version(a))), -expected)
+
+    def test_hash_consistent_with_eq(self):
+        for a, b, expected in KNOWN_CASES:
+            if expected == 0:
+                with self.subTest(a=a, b=b):
+                    self.assertEqual(hash(Version(a)), hash(Version(b)))
+
+    @skipUnless(which('vercmp'), 'vercmp(8) is not installed')
+    def test_against_vercmp(self):
+        random = Random(0)
+        pairs = [(random_version(random), random_version(random)) for _ in range(NUM_RANDOM_PAIRS)]
+        self.assert_same_as_vercmp(pairs)
+
+    @skipUnless(which('vercmp'), 'vercmp(8) is not installed')
+    def test_real_versions_against_vercmp(self):
+        self.assert_same_as_vercmp(combinations(REAL_VERSIONS, 2))
+
+    def assert_same_as_vercmp(self, pairs):
+        """ :param pairs: Iterable of pairs of version strings. """
+        for a, b in pairs:
+            with self.subTest(a=a, b=b):
+                expected = int(run(['vercmp', a, b], stdout=PIPE, check=True).stdout)
+                self.assertEqual(sign(Version(a).cmp(Version(b))), sign(expected))
+
+
+if __name__ == '__main__':
+    main()